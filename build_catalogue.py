@@ -0,0 +1,284 @@
+"""Builds the catalogue file robot_galah.py loads from the GALAH DR3 FITS tables.
+
+The allstar table is read a chunk of rows at a time and joined on sobject_id
+to the BSTEP ages and dynamics value-added catalogues, which are looked up
+with a binary search over their sobject_id column. Only the columns the bot
+uses are read, so memory use is set by the chunk size and not by the size of
+the release. Progress is saved after each chunk, so an interrupted build
+carries on where it stopped, and a build whose inputs haven't changed does
+nothing.
+
+The output is an HDF5 table with the tweet text columns already worked out,
+and an index file (see ``catalogue.save_index``) with the eligible stars and
+sort orders for looking stars up."""
+
+import argparse
+import json
+import logging
+import logging.config
+import os
+import sys
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+from astropy.io import fits
+
+from catalogue import (
+    FLAG_COLUMNS,
+    FLOAT32_COLUMNS,
+    FULL_PRECISION_COLUMNS,
+    LOOKUP_COLUMNS,
+    basic_cuts,
+    save_index,
+)
+from text_fields import TEXT_COLUMNS, add_text_columns
+
+KEY = "galah_dr3"
+WANTED_COLUMNS = (
+    FULL_PRECISION_COLUMNS + FLOAT32_COLUMNS + FLAG_COLUMNS + ["survey_name"]
+)
+# Longest strings allowed in the HDF5 table.
+STRING_SIZES = dict({"survey_name": 32}, **{column: 32 for column in TEXT_COLUMNS})
+
+
+def _native(values):
+    """FITS columns are big-endian and strings are bytes; pandas wants neither."""
+    values = np.asarray(values)
+    if values.dtype.kind == "S":
+        return np.char.decode(values, "ascii").astype(object)
+    return values.astype(values.dtype.newbyteorder("="))
+
+
+class FitsTable:
+    """The first table extension of a FITS file, memory-mapped."""
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self.hdul = fits.open(self.path, memmap=True)
+        self.data = self.hdul[1].data
+        self.columns = set(self.data.columns.names)
+        self.n_rows = len(self.data)
+        if "sobject_id" not in self.columns:
+            sys.exit(f"{self.path} has no sobject_id column. Quitting.")
+
+    def read(self, columns, rows):
+        return {column: _native(self.data[column][rows]) for column in columns}
+
+    def close(self):
+        self.hdul.close()
+
+
+class SideTable(FitsTable):
+    """A value-added catalogue to join to the allstar table on sobject_id."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self.ids = _native(self.data["sobject_id"]).astype(np.int64)
+        self.order = np.argsort(self.ids, kind="stable")
+
+    def join(self, sobject_ids, columns):
+        """``columns`` for each of ``sobject_ids``, NaN where a star is missing."""
+        positions = np.searchsorted(self.ids, sobject_ids, sorter=self.order)
+        rows = self.order[np.minimum(positions, self.n_rows - 1)]
+        found = self.ids[rows] == sobject_ids
+        joined = {}
+        for column in columns:
+            values = np.full(len(sobject_ids), np.nan)
+            values[found] = _native(self.data[column][rows[found]])
+            joined[column] = values
+        return joined
+
+
+def _signature(paths, chunk_rows):
+    # Which columns are worked out, so builds made before one was added are redone.
+    signature = {"chunk_rows": chunk_rows, "derived": ["U_UVW_W_UVW"]}
+    for name, path in paths.items():
+        stat = Path(path).stat()
+        signature[name] = [str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns]
+    return signature
+
+
+def _read_state(state_file):
+    try:
+        return json.loads(Path(state_file).read_text(encoding="utf-8"))
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_state(state_file, signature, rows_done, complete=False):
+    tmp_file = Path(f"{state_file}.tmp")
+    tmp_file.write_text(
+        json.dumps(
+            {"signature": signature, "rows_done": rows_done, "complete": complete}
+        ),
+        encoding="utf-8",
+    )
+    os.replace(tmp_file, state_file)
+
+
+def _make_chunk(allstar, plan, start, stop):
+    """Rows ``start:stop`` of the allstar table joined to the other tables."""
+    columns = allstar.read(plan[allstar], slice(start, stop))
+    sobject_ids = columns["sobject_id"].astype(np.int64)
+    for table, table_columns in plan.items():
+        if table is not allstar:
+            columns.update(table.join(sobject_ids, table_columns))
+    chunk = pd.DataFrame(columns, index=pd.RangeIndex(start, stop))
+    if "U_UVW_W_UVW" not in chunk and {"U_UVW", "W_UVW"} <= set(chunk):
+        # The speed out of the plane of rotation, for the Toomre diagram.
+        chunk["U_UVW_W_UVW"] = np.hypot(chunk["U_UVW"], chunk["W_UVW"])
+    for column in FLOAT32_COLUMNS:
+        if column in chunk:
+            chunk[column] = chunk[column].astype(np.float32)
+    if "survey_name" in chunk:
+        chunk["survey_name"] = chunk["survey_name"].str.strip()
+    add_text_columns(chunk, np.flatnonzero(basic_cuts(chunk).to_numpy()))
+    return chunk
+
+
+def _write_index(out_file, chunk_rows):
+    """Works out the eligible stars and lookup orders from the finished file."""
+    id_columns = {column: [] for column in LOOKUP_COLUMNS}
+    eligible = []
+    with pd.HDFStore(out_file, mode="r") as store:
+        available = store.select(KEY, start=0, stop=1).columns
+        wanted = [
+            column
+            for column in LOOKUP_COLUMNS + ["flag_sp", "flag_fe_h", "snr_c3_iraf"]
+            if column in available
+        ]
+        for chunk in store.select(KEY, columns=wanted, chunksize=chunk_rows):
+            for column in LOOKUP_COLUMNS:
+                if column in chunk:
+                    id_columns[column].append(chunk[column].to_numpy())
+            eligible.append(chunk.index.to_numpy()[basic_cuts(chunk).to_numpy()])
+    ids = pd.DataFrame(
+        {column: np.concatenate(parts) for column, parts in id_columns.items() if parts}
+    )
+    eligible = np.concatenate(eligible).astype(np.int64)
+    save_index(out_file, ids, eligible)
+    return len(ids), len(eligible)
+
+
+def build(allstar_file, ages_file, dynamics_file, out_file, chunk_rows=100_000):
+    """Builds ``out_file``, carrying on from an interrupted build if there was one."""
+    logger = logging.getLogger("build_catalogue")
+    out_file = Path(out_file)
+    partial_file = out_file.with_name(f"{out_file.name}.partial")
+    state_file = out_file.with_name(f"{out_file.name}.build.json")
+    signature = _signature(
+        {"allstar": allstar_file, "ages": ages_file, "dynamics": dynamics_file},
+        chunk_rows,
+    )
+    state = _read_state(state_file)
+    if state is not None and state["signature"] == signature:
+        if state["complete"] and out_file.exists():
+            logger.info("%s is up to date", out_file)
+            return out_file
+        rows_done = state["rows_done"] if partial_file.exists() else 0
+    else:
+        rows_done = 0
+    if rows_done == 0 and partial_file.exists():
+        partial_file.unlink()
+
+    allstar = FitsTable(allstar_file)
+    tables = [allstar, SideTable(ages_file), SideTable(dynamics_file)]
+    # Each column comes from the first table that has it.
+    plan = {}
+    taken = set()
+    for table in tables:
+        plan[table] = [
+            column
+            for column in WANTED_COLUMNS
+            if column in table.columns and column not in taken
+        ]
+        taken.update(plan[table])
+        logger.info("Using %s from %s", ", ".join(plan[table]), table.path)
+    missing = {
+        "sobject_id",
+        "flag_sp",
+        "flag_fe_h",
+        "snr_c3_iraf",
+        "age_bstep",
+        "distance_bstep",
+        "e_distance_bstep",
+        "m_act_bstep",
+    }
+    missing -= taken
+    if missing:
+        sys.exit(f"The input tables have no {sorted(missing)} columns. Quitting.")
+
+    try:
+        with pd.HDFStore(partial_file, mode="a") as store:
+            if KEY in store and store.get_storer(KEY).nrows > rows_done:
+                # Rows written after the last saved progress.
+                store.remove(KEY, start=rows_done)
+            if rows_done:
+                logger.info("Carrying on from row %i", rows_done)
+            for start in range(rows_done, allstar.n_rows, chunk_rows):
+                stop = min(start + chunk_rows, allstar.n_rows)
+                chunk = _make_chunk(allstar, plan, start, stop)
+                store.append(
+                    KEY,
+                    chunk,
+                    format="table",
+                    index=False,
+                    min_itemsize={
+                        column: size
+                        for column, size in STRING_SIZES.items()
+                        if column in chunk
+                    },
+                )
+                store.flush(fsync=True)
+                _write_state(state_file, signature, stop)
+                logger.info("Wrote rows %i to %i of %i", start, stop, allstar.n_rows)
+    finally:
+        for table in tables:
+            table.close()
+
+    os.replace(partial_file, out_file)
+    n_rows, n_eligible = _write_index(out_file, chunk_rows)
+    _write_state(state_file, signature, n_rows, complete=True)
+    logger.info("Built %s: %i stars, %i eligible", out_file, n_rows, n_eligible)
+    return out_file
+
+
+def main():
+    cwd = Path(__file__).parent
+    logging.config.fileConfig(Path.joinpath(cwd, "logging.conf"))
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("allstar_file", help="GALAH DR3 allstar FITS table.")
+    parser.add_argument("ages_file", help="BSTEP ages value-added catalogue (FITS).")
+    parser.add_argument("dynamics_file", help="Dynamics value-added catalogue (FITS).")
+    parser.add_argument("out_file", help="The HDF5 file to write.")
+    parser.add_argument(
+        "--chunk_rows",
+        help="Rows of the allstar table to read at a time.",
+        type=int,
+        default=100_000,
+    )
+    parser.add_argument(
+        "--restart",
+        help="Start again rather than carrying on from an interrupted build.",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    if args.restart:
+        try:
+            Path(f"{args.out_file}.build.json").unlink()
+        except FileNotFoundError:
+            pass
+    out_file = build(
+        args.allstar_file,
+        args.ages_file,
+        args.dynamics_file,
+        args.out_file,
+        args.chunk_rows,
+    )
+    print(f"Built {out_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,382 @@
+"""Loading the GALAH DR3 catalogue used to pick stars."""
+
+import argparse
+import gc
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from metrics import peak_rss_mb, rss_mb
+from posted_history import PostedHistory
+from sampler import load_sampler
+from spatial import FIELD_OF_VIEW_DEG, SimbadReference, SkyIndex
+from text_fields import TEXT_COLUMNS, add_text_columns
+
+# The columns used to choose, describe and plot a star, by how they are kept
+# in a compact catalogue. Everything else in the file is dropped. Ids,
+# positions and the values the tweet text comes from stay at full precision
+# so nothing that is printed changes.
+FULL_PRECISION_COLUMNS = [
+    "sobject_id",
+    "dr2_source_id",
+    "dr3_source_id",
+    "ra",
+    "dec",
+    "ra_dr2",
+    "dec_dr2",
+    "snr_c3_iraf",
+    "age_bstep",
+    "distance_bstep",
+    "e_distance_bstep",
+    "m_act_bstep",
+    "simbad_main_id",
+]
+FLOAT32_COLUMNS = [
+    "teff",
+    "logg",
+    "fe_h",
+    "alpha_fe",
+    "L_Z",
+    "Energy",
+    "U_UVW",
+    "V_UVW",
+    "W_UVW",
+    "U_UVW_W_UVW",
+    "rv_galah",
+]
+FLAG_COLUMNS = ["flag_sp", "flag_fe_h", "flag_alpha_fe"]
+CATEGORY_COLUMNS = ["survey_name"] + TEXT_COLUMNS
+KEPT_COLUMNS = (
+    FULL_PRECISION_COLUMNS + FLOAT32_COLUMNS + FLAG_COLUMNS + CATEGORY_COLUMNS
+)
+# Columns that stars can be looked up by.
+LOOKUP_COLUMNS = ["sobject_id", "dr3_source_id"]
+# Rows read at a time from a table-format catalogue.
+CHUNK_ROWS = 100_000
+
+
+def catalogue_path(secrets_dict):
+    """Path to the catalogue file named in the secrets."""
+    return Path(secrets_dict["DATA_DIR"]) / secrets_dict["DATA_FILE"]
+
+
+def history_path(secrets_dict):
+    """Path to the record of which stars have been tweeted."""
+    return Path(
+        secrets_dict.get(
+            "HISTORY_FILE", Path.joinpath(Path(__file__).parent, "posted_history.bin")
+        )
+    )
+
+
+def basic_cuts(galah_dr3):
+    """The GALAH team recommended cuts for a star to be worth tweeting."""
+    return (
+        (galah_dr3["flag_sp"] == 0)
+        & (galah_dr3["flag_fe_h"] == 0)
+        & (galah_dr3["snr_c3_iraf"] > 30)
+    )
+
+
+def compact(galah_dr3):
+    """A copy of the catalogue with only the columns we use, in small dtypes.
+
+    Plotted values become float32, flags the smallest int that holds them,
+    and ``survey_name`` (stripped) and the text columns categoricals."""
+    columns = {}
+    for column in galah_dr3.columns:
+        values = galah_dr3[column]
+        if column in FULL_PRECISION_COLUMNS:
+            columns[column] = values
+        elif column in FLOAT32_COLUMNS:
+            columns[column] = values.astype(np.float32)
+        elif column in FLAG_COLUMNS:
+            columns[column] = pd.to_numeric(values, downcast="integer")
+        elif column == "survey_name":
+            columns[column] = values.str.strip().astype("category")
+        elif column in CATEGORY_COLUMNS:
+            columns[column] = values.astype("category")
+    return pd.DataFrame(columns, index=galah_dr3.index)
+
+
+def read_catalogue(path, compact_columns=True, chunk_rows=CHUNK_ROWS):
+    """Reads the catalogue, compacted unless ``compact_columns`` is False.
+
+    A table-format file (as ``build_catalogue.py`` writes) is read
+    ``chunk_rows`` at a time and only the KEPT_COLUMNS, so the dropped
+    columns and the full-size dtypes never take up memory all at once. A
+    fixed-format file can only be read whole and compacted afterwards."""
+    with pd.HDFStore(path, mode="r") as store:
+        (key,) = store.keys()
+        if not compact_columns or not store.get_storer(key).is_table:
+            galah_dr3 = store.select(key)
+            return compact(galah_dr3) if compact_columns else galah_dr3
+        available = store.select(key, start=0, stop=0).columns
+        wanted = [column for column in available if column in KEPT_COLUMNS]
+        chunks = [
+            compact(chunk)
+            for chunk in store.select(key, columns=wanted, chunksize=chunk_rows)
+        ]
+    galah_dr3 = pd.concat(chunks) if len(chunks) > 1 else chunks[0]
+    for column in CATEGORY_COLUMNS:
+        # Chunks with different categories concatenate to object columns.
+        if column in galah_dr3 and galah_dr3[column].dtype != "category":
+            galah_dr3[column] = galah_dr3[column].astype("category")
+    return galah_dr3
+
+
+def index_path(catalogue_file):
+    """Where the eligible stars and lookup indexes for a catalogue are saved."""
+    catalogue_file = Path(catalogue_file)
+    return catalogue_file.with_name(f"{catalogue_file.name}.index.npz")
+
+
+def _file_signature(path):
+    stat = Path(path).stat()
+    return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+
+def save_index(catalogue_file, galah_dr3, eligible):
+    """Saves ``eligible`` and a sort order for each of the LOOKUP_COLUMNS."""
+    lookups = {
+        f"order_{column}": np.argsort(galah_dr3[column].to_numpy(), kind="stable")
+        for column in LOOKUP_COLUMNS
+        if column in galah_dr3
+    }
+    np.savez(
+        index_path(catalogue_file),
+        signature=_file_signature(catalogue_file),
+        eligible=eligible,
+        **lookups,
+    )
+
+
+def load_index(catalogue_file, n_rows):
+    """The saved index, or None if there isn't one for this version of the file."""
+    path = index_path(catalogue_file)
+    if not path.exists():
+        return None
+    with np.load(path) as saved:
+        if not np.array_equal(saved["signature"], _file_signature(catalogue_file)):
+            return None
+        index = {key: saved[key] for key in saved.files}
+    if any(len(index[key]) != n_rows for key in index if key.startswith("order_")):
+        return None
+    return index
+
+
+def memory_mb(galah_dr3):
+    return galah_dr3.memory_usage(deep=True).sum() / 1024**2
+
+
+class Catalogue:
+    """The catalogue, its eligible-star index and where it was loaded from.
+
+    ``eligible`` holds the row positions of the stars passing the basic cuts.
+    If ``history_file`` is given, ``history`` records which of them have been
+    tweeted so random stars are drawn without replacement. If ``stratify`` is
+    given, ``sampler`` draws stars with per-stratum ``weights`` instead of
+    uniformly. Unless ``compact`` is False, only the columns we use are kept,
+    in small dtypes (see ``compact()``). If ``build_catalogue.py`` saved an
+    index with the file, the eligible stars come from it and ``find()`` looks
+    stars up with a binary search. ``simbad`` is the local SIMBAD extract
+    from ``reference_file``, if there is one, and ``in_field()`` finds the
+    GALAH stars in a sky image.
+    ``stale()`` tells a long-running process when the file on disk has
+    changed, so it can call ``load()`` again."""
+
+    def __init__(
+        self,
+        path,
+        history_file=None,
+        stratify=None,
+        weights=None,
+        compact=True,
+        reference_file=None,
+    ):
+        self.path = Path(path)
+        self.reference_file = reference_file
+        self.simbad = None
+        self.field_index = None
+        self.compact = compact
+        self.history_file = history_file
+        self.stratify = stratify
+        self.weights = weights
+        self.sampler = None
+        self.galah_dr3 = None
+        self.basest_idx_galah = None
+        self.eligible = None
+        self.lookup = {}
+        self.history = None
+        self.mtime = None
+
+    @classmethod
+    def from_secrets(
+        cls, secrets_dict, use_history=True, stratify=None, weights=None, compact=True
+    ):
+        history_file = history_path(secrets_dict) if use_history else None
+        return cls(
+            catalogue_path(secrets_dict),
+            history_file,
+            stratify,
+            weights,
+            compact,
+            secrets_dict.get("SIMBAD_REFERENCE_FILE"),
+        )
+
+    def load(self):
+        logger = logging.getLogger("catalogue")
+        logger.info("Loading the catalogue from %s", self.path)
+        mtime = self.path.stat().st_mtime
+        galah_dr3 = read_catalogue(self.path, self.compact)
+        index = load_index(self.path, len(galah_dr3))
+        if index is not None:
+            logger.info("Using the saved index %s", index_path(self.path))
+            self.eligible = index["eligible"]
+            mask = np.zeros(len(galah_dr3), dtype=bool)
+            mask[self.eligible] = True
+            self.basest_idx_galah = pd.Series(mask, index=galah_dr3.index)
+            self.lookup = {
+                column: index[f"order_{column}"]
+                for column in LOOKUP_COLUMNS
+                if f"order_{column}" in index
+            }
+        else:
+            self.basest_idx_galah = basic_cuts(galah_dr3)
+            self.eligible = np.flatnonzero(self.basest_idx_galah.to_numpy())
+            self.lookup = {}
+        if not all(column in galah_dr3 for column in TEXT_COLUMNS):
+            add_text_columns(galah_dr3, self.eligible)
+            if self.compact:
+                for column in TEXT_COLUMNS:
+                    galah_dr3[column] = galah_dr3[column].astype("category")
+        if self.reference_file is not None:
+            self.simbad = SimbadReference.load(self.reference_file)
+            logger.info(
+                "Loaded %i SIMBAD objects from %s",
+                len(self.simbad),
+                self.reference_file,
+            )
+        if self.stratify is not None:
+            self.sampler = load_sampler(
+                galah_dr3,
+                self.eligible,
+                self.path,
+                self.stratify,
+                self.weights,
+                self.simbad,
+            )
+        if self.history_file is not None:
+            self.history = PostedHistory(
+                self.history_file,
+                galah_dr3["sobject_id"].to_numpy()[self.eligible],
+            )
+            logger.info(
+                "%i eligible stars have not been tweeted", self.history.remaining
+            )
+        self.galah_dr3 = galah_dr3
+        self.field_index = None
+        self.mtime = mtime
+        logger.info(
+            "Loaded %i stars, %i pass the basic cuts",
+            len(galah_dr3),
+            self.basest_idx_galah.sum(),
+        )
+        logger.info("The catalogue takes %.1f MB", memory_mb(galah_dr3))
+        return self
+
+    def find(self, column, value):
+        """Row positions of the stars with ``column`` equal to ``value``."""
+        values = self.galah_dr3[column].to_numpy()
+        order = self.lookup.get(column)
+        if order is None:
+            return np.flatnonzero(values == value)
+        start = np.searchsorted(values, value, side="left", sorter=order)
+        stop = np.searchsorted(values, value, side="right", sorter=order)
+        return np.sort(order[start:stop])
+
+    def release(self, sobject_id, epoch):
+        """Gives back a star drawn in history ``epoch`` that wasn't tweeted."""
+        if self.history is None:
+            return False
+        row = self.find("sobject_id", sobject_id)
+        position = np.searchsorted(self.eligible, row[0]) if len(row) else -1
+        if position < 0 or self.eligible[position] != row[0]:
+            return False
+        return self.history.release(int(position), epoch)
+
+    def in_field(self, ra, dec, fov_deg=FIELD_OF_VIEW_DEG):
+        """Row positions of the stars in the sky image centred on (ra, dec)."""
+        if self.field_index is None:
+            self.field_index = SkyIndex(
+                self.galah_dr3["ra_dr2"].to_numpy(),
+                self.galah_dr3["dec_dr2"].to_numpy(),
+            )
+        return self.field_index.in_field(ra, dec, fov_deg)
+
+    def stale(self):
+        try:
+            return self.path.stat().st_mtime != self.mtime
+        except FileNotFoundError:
+            # Mid-replace; keep what we have until the new file appears.
+            return False
+
+
+def _footprint(path, compact):
+    """Loads the catalogue and measures it. Run in a new process for each."""
+    galah_dr3 = Catalogue(path, compact=compact).load().galah_dr3
+    gc.collect()
+    return {
+        "columns": len(galah_dr3.columns),
+        "memory_mb": memory_mb(galah_dr3),
+        "peak_rss_mb": peak_rss_mb(),
+        "rss_mb": rss_mb(),
+        "column_mb": (
+            galah_dr3.memory_usage(deep=True, index=False) / 1024**2
+        ).to_dict(),
+        "dtypes": galah_dr3.dtypes.astype(str).to_dict(),
+    }
+
+
+def memory_report(path):
+    """Compares the memory used by the full and compact catalogues."""
+    footprints = {}
+    for name, compact in [("full", False), ("compact", True)]:
+        # A fresh process each, so the peak RSS is for that load alone.
+        with ProcessPoolExecutor(max_workers=1) as executor:
+            footprints[name] = executor.submit(_footprint, path, compact).result()
+    full, small = footprints["full"], footprints["compact"]
+    print(f"{'column':<20} {'full':>18} {'compact':>18}")
+    for column in small["column_mb"]:
+        print(
+            f"{column:<20} "
+            f"{full['dtypes'][column]:>8} {full['column_mb'][column]:>6.1f} MB  "
+            f"{small['dtypes'][column]:>8} {small['column_mb'][column]:>6.1f} MB"
+        )
+    for key, label in [
+        ("columns", "Columns"),
+        ("memory_mb", "DataFrame (MB)"),
+        ("rss_mb", "RSS after load (MB)"),
+        ("peak_rss_mb", "Peak RSS (MB)"),
+    ]:
+        values = [
+            "n/a" if value is None else f"{value:.0f}"
+            for value in (full[key], small[key])
+        ]
+        print(f"{label:<20} {values[0]:>18} {values[1]:>18}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare the memory used by the full and compact catalogues."
+    )
+    parser.add_argument("catalogue_file", help="The catalogue HDF5 file.")
+    args = parser.parse_args()
+    memory_report(args.catalogue_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""Run the bot as one long-lived process that tweets on a schedule.
+
+The catalogue, the eligible-star index, matplotlib/astropy and the HTTP
+sessions stay loaded between tweets, so each tweet only pays for the work on
+its own star."""
+
+import json
+import logging
+import os
+import signal
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+from catalogue import Catalogue, catalogue_path, memory_mb
+from metrics import RunMetrics, peak_rss_mb
+
+
+def _timestamp(t):
+    if t is None:
+        return None
+    return datetime.fromtimestamp(t, timezone.utc).isoformat()
+
+
+class Daemon:
+    """Tweets every ``cadence_minutes`` until it gets SIGTERM or SIGINT.
+
+    ``get_secrets`` is called whenever we check for a reload, so a change of
+    ``DATA_FILE`` in the secrets, or a new file written over the old one, is
+    picked up before the next tweet. SIGHUP forces a reload. A failed tweet is
+    logged and the daemon carries on with the next one. The current state is
+    written to ``robot_galah_health.json`` after every check. With
+    ``reset_history`` a new history epoch is started once the catalogue is
+    first loaded."""
+
+    def __init__(
+        self,
+        cwd,
+        get_secrets,
+        post,
+        cadence_minutes,
+        post_now=False,
+        metrics_file=None,
+        profile_stage=None,
+        profiler="cprofile",
+        poll_seconds=30,
+        queue=None,
+        catalogue_options=None,
+        reset_history=False,
+    ):
+        self.cwd = Path(cwd)
+        self.get_secrets = get_secrets
+        self.post = post
+        self.cadence = cadence_minutes * 60
+        self.post_now = post_now
+        self.metrics_file = metrics_file
+        self.profile_stage = profile_stage
+        self.profiler = profiler
+        self.poll_seconds = poll_seconds
+        self.queue = queue
+        # Keyword arguments for Catalogue.from_secrets.
+        self.catalogue_options = catalogue_options or {}
+        self.reset_history = reset_history
+        # Threads (e.g. a staging.Stager) started once the catalogue is loaded.
+        self.background = []
+        self.health_file = Path.joinpath(self.cwd, "robot_galah_health.json")
+        self.logger = logging.getLogger("daemon")
+
+        self.secrets_dict = None
+        self.catalogue = None
+        self._stop = threading.Event()
+        self._reload_requested = False
+
+        self.state = "starting"
+        self.started = time.time()
+        self.next_post = None
+        self.last_post = None
+        self.last_reload = None
+        self.posts_ok = 0
+        self.posts_failed = 0
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._handle_stop)
+        signal.signal(signal.SIGINT, self._handle_stop)
+        signal.signal(signal.SIGHUP, self._handle_reload)
+
+        self.secrets_dict = self.get_secrets()
+        self.catalogue = Catalogue.from_secrets(
+            self.secrets_dict, **self.catalogue_options
+        ).load()
+        if self.reset_history and self.catalogue.history is not None:
+            self.catalogue.history.new_epoch()
+        self.last_reload = time.time()
+        for thread in self.background:
+            thread.start()
+
+        self.next_post = time.time() + (0 if self.post_now else self.cadence)
+        self.logger.info(
+            "Daemon started, tweeting every %0.1f minutes. First at %s",
+            self.cadence / 60,
+            _timestamp(self.next_post),
+        )
+        while not self._stop.is_set():
+            self.state = "idle"
+            self._maybe_reload()
+            delay = self.next_post - time.time()
+            if delay > 0:
+                self.write_health()
+                self._stop.wait(min(delay, self.poll_seconds))
+                continue
+            self._post()
+            # Don't try to catch up on tweets we missed while busy.
+            while self.next_post <= time.time():
+                self.next_post += self.cadence
+        for thread in self.background:
+            thread.stop()
+            thread.join()
+        self.state = "stopped"
+        self.write_health()
+        self.logger.info("Daemon stopped")
+
+    def _post(self):
+        self.state = "posting"
+        self.write_health()
+        metrics = RunMetrics(profile_stage=self.profile_stage, profiler=self.profiler)
+        start = time.time()
+        try:
+            with metrics.recording(self.metrics_file):
+                self.post(self.catalogue, self.secrets_dict, metrics)
+        except SystemExit as e:
+            # The pipeline quits with sys.exit when an upstream service fails.
+            self.logger.error("Tweet failed: %s", e.code)
+        except Exception:
+            self.logger.exception("Tweet failed")
+        if metrics.status == "ok":
+            self.posts_ok += 1
+        else:
+            self.posts_failed += 1
+        self.last_post = {
+            "time": _timestamp(start),
+            "status": metrics.status,
+            "sobject_id": metrics.info.get("sobject_id"),
+            "duration_s": round(time.time() - start, 2),
+        }
+
+    def _maybe_reload(self):
+        try:
+            secrets_dict = self.get_secrets()
+        except SystemExit:
+            self.logger.error("Could not re-read the secrets, keeping the old ones")
+            secrets_dict = self.secrets_dict
+        path = catalogue_path(secrets_dict)
+        if not (
+            self._reload_requested
+            or path != self.catalogue.path
+            or self.catalogue.stale()
+        ):
+            self.secrets_dict = secrets_dict
+            return
+        self._reload_requested = False
+        self.state = "reloading"
+        self.logger.info("Reloading the catalogue from %s", path)
+        try:
+            catalogue = Catalogue.from_secrets(
+                secrets_dict, **self.catalogue_options
+            ).load()
+        except Exception:
+            # e.g. the file is still being written; try again next time.
+            self.logger.exception("Reload failed, keeping the old catalogue")
+            return
+        self.catalogue = catalogue
+        self.secrets_dict = secrets_dict
+        self.last_reload = time.time()
+
+    def _handle_stop(self, signum, frame):
+        self.logger.info("Got signal %i, stopping", signum)
+        self.state = "stopping"
+        self._stop.set()
+
+    def _handle_reload(self, signum, frame):
+        self.logger.info("Got SIGHUP, will reload the catalogue")
+        self._reload_requested = True
+
+    def health(self):
+        catalogue = {}
+        if self.catalogue is not None and self.catalogue.galah_dr3 is not None:
+            catalogue = {
+                "path": str(self.catalogue.path),
+                "mtime": _timestamp(self.catalogue.mtime),
+                "stars": len(self.catalogue.galah_dr3),
+                "eligible": len(self.catalogue.eligible),
+                "memory_mb": round(memory_mb(self.catalogue.galah_dr3), 1),
+                "not_yet_tweeted": (
+                    None
+                    if self.catalogue.history is None
+                    else self.catalogue.history.remaining
+                ),
+            }
+        return {
+            "pid": os.getpid(),
+            "state": self.state,
+            "heartbeat": _timestamp(time.time()),
+            "started": _timestamp(self.started),
+            "uptime_s": round(time.time() - self.started),
+            "next_post": _timestamp(self.next_post),
+            "last_post": self.last_post,
+            "posts_ok": self.posts_ok,
+            "posts_failed": self.posts_failed,
+            "last_reload": _timestamp(self.last_reload),
+            "catalogue": catalogue,
+            "staged": None if self.queue is None else len(self.queue),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+
+    def write_health(self):
+        tmp_file = self.health_file.with_suffix(".json.tmp")
+        tmp_file.write_text(json.dumps(self.health(), indent=2), encoding="utf-8")
+        os.replace(tmp_file, self.health_file)
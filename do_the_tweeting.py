@@ -1,18 +1,26 @@
 import logging
-import logging.config
 import sys
 from pathlib import Path
 
 import tweepy
 from tweepy.error import TweepError
 
+import throttle
+from metrics import RunMetrics
 
-def media_load(filename, alt_text, api, logger):
+
+def media_load(filename, alt_text, api, logger, metrics=None):
     """Load the images and gets the media IDs for Twitter."""
     logger.info("Getting media_id for %s", filename)
     try:
         with open(filename, "rb") as file:
-            media = api.media_upload(filename=filename, file=file)
+
+            def upload():
+                # From the start again if the upload is retried.
+                file.seek(0)
+                return api.media_upload(filename=filename, file=file)
+
+            media = throttle.call("twitter_media", upload, metrics=metrics)
     except FileNotFoundError as e:
         logger.error(e)
         logger.error("Image to tweet does not exist. Quitting.")
@@ -26,24 +34,32 @@ def media_load(filename, alt_text, api, logger):
     return media.media_id_string
 
 
-def tweet(tweet_text, hips_survey, BEST_NAME, secrets_dict, DRY_RUN=False):
-
-    cwd = Path(__file__).parent
-
-    tweet_content_dir = Path.joinpath(cwd, "tweet_content")
-    config_file = Path.joinpath(cwd, "logging.conf")
-
-    logging.config.fileConfig(config_file)
-    # create logger
-    logger = logging.getLogger("do_the_tweeting")
-
-    alt_text_dict = {
+def alt_texts(hips_survey, BEST_NAME):
+    """The images to tweet and their alt text, in the order they are tweeted."""
+    return {
         "sky_image_overlay.jpg": f"A 15 by 15 arcminute image from the {hips_survey}. {BEST_NAME} is found at the centre.",
         "stellar_params_teff.png": f"Two graphs made from GALAH survey data. The top panel is a temperature versus surface gravity, and the bottom panel is the Tinsley-Wallerstein diagram showing the metallicity versus the alpha abundance. On both, {BEST_NAME} is indicated with a big red star.",
         "stellar_params_L_Z.png": f"Two graphs made from GALAH survey data. The top panel is the z-component of the angular momentum versus the orbital energy. The bottom panel is the Toomre diagram. On both, {BEST_NAME} is indicated with a big red star.",
         "spectra.png": f"The normalized HERMES spectrum of {BEST_NAME}. HERMES acquires the spectrum of the star in four non-contiguous wavelength regions: Blue, Green, Red, and Infrared.",
     }
 
+
+def tweet(
+    tweet_text,
+    hips_survey,
+    BEST_NAME,
+    secrets_dict,
+    tweet_content_dir,
+    DRY_RUN=False,
+    metrics=None,
+):
+    if metrics is None:
+        metrics = RunMetrics()
+
+    logger = logging.getLogger("do_the_tweeting")
+
+    alt_text_dict = alt_texts(hips_survey, BEST_NAME)
+
     auth = tweepy.OAuthHandler(
         secrets_dict["consumer_key"], secrets_dict["consumer_secret"]
     )
@@ -51,10 +67,21 @@ def tweet(tweet_text, hips_survey, BEST_NAME, secrets_dict, DRY_RUN=False):
 
     api = tweepy.API(auth)
 
-    media_id = [
-        media_load(Path.joinpath(tweet_content_dir, filename), alt_text, api, logger)
-        for filename, alt_text in alt_text_dict.items()
-    ]
+    with metrics.stage("tweet.media_upload"):
+        media_id = [
+            media_load(
+                Path.joinpath(tweet_content_dir, filename),
+                alt_text,
+                api,
+                logger,
+                metrics,
+            )
+            for filename, alt_text in alt_text_dict.items()
+        ]
+    for filename in alt_text_dict:
+        metrics.add_bytes(
+            "twitter_media", Path.joinpath(tweet_content_dir, filename).stat().st_size
+        )
     try:
         if not DRY_RUN:
             tweet_return = api.update_status(status=tweet_text, media_ids=media_id)
@@ -63,7 +90,6 @@ def tweet(tweet_text, hips_survey, BEST_NAME, secrets_dict, DRY_RUN=False):
             )
         else:
             logger.info("Only a dry run, so not tweeting.")
-        sys.exit()
     except TweepError as e:
         logger.error(e)
         logger.error("Did not sucessfully tweet! Quitting!")
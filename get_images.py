@@ -1,20 +1,25 @@
 import logging
-import logging.config
 import shutil
 import sys
+from functools import lru_cache
 from pathlib import Path
 
 import requests
 from PIL import Image, ImageDraw, ImageFont
 
+import throttle
+from metrics import RunMetrics
 
-def download_image(survey_url, star_ra, star_dec, logger, base_image):
+
+def download_image(survey_url, star_ra, star_dec, logger, base_image, metrics=None):
     """Downloads the HiPS image.
 
     This research made use of hips2fits,
     (https://alasky.u-strasbg.fr/hips-image-services/hips2fits)
     a service provided by CDS."""
-    response = requests.get(
+    response = throttle.call(
+        "hips2fits",
+        throttle.session().get,
         url="http://alasky.u-strasbg.fr/hips-image-services/hips2fits",
         params={
             "hips": survey_url,
@@ -29,6 +34,7 @@ def download_image(survey_url, star_ra, star_dec, logger, base_image):
             "stretch": "linear",
         },
         stream=True,
+        metrics=metrics,
     )
     logger.debug("Tried %s", response.url)
     if response.status_code < 400:
@@ -57,13 +63,19 @@ def get_best_survey(avail_hips, wanted_surveys, star_dec):
     return list(filter(lambda x: x["ID"] == best_survey_id, avail_hips))[0]
 
 
+@lru_cache(maxsize=None)
+def load_font(font_dir, size):
+    """Loads the overlay font once per process."""
+    # Necessary to force to a string here for the ImageFont bit.
+    return ImageFont.truetype(
+        str(Path.joinpath(Path(font_dir), "Roboto-Bold.ttf")), size
+    )
+
+
 def add_overlay(
     base_image, secrets_dict, logger, tweet_content_dir, BEST_NAME, survey_name
 ):
-    # Necessary to force to a string here for the ImageFont bit.
-    font = ImageFont.truetype(
-        str(Path.joinpath(Path(secrets_dict["font_dir"]), "Roboto-Bold.ttf")), 40
-    )
+    font = load_font(secrets_dict["font_dir"], 40)
     try:
         img_sky = Image.open(base_image)
     except FileNotFoundError as e:
@@ -85,13 +97,53 @@ def add_overlay(
     logger.info("Saved overlayed image to %s", overlayed_image)
 
 
-def get_hips_image(star_ra, star_dec, BEST_NAME, secrets_dict):
+def get_hips_image(
+    star_ra, star_dec, BEST_NAME, secrets_dict, tweet_content_dir, metrics=None
+):
     """Main function to get a sky image for the given star."""
-    cwd = Path(__file__).parent
-    tweet_content_dir = Path.joinpath(cwd, "tweet_content")
-    config_file = Path.joinpath(cwd, "logging.conf")
-    logging.config.fileConfig(config_file)
-    # create logger
+    if metrics is None:
+        metrics = RunMetrics()
+    base_image, image_source = fetch_hips_image(
+        star_ra, star_dec, tweet_content_dir, metrics, secrets_dict
+    )
+    logger = logging.getLogger("get_images")
+    with metrics.stage("get_hips_image.overlay"):
+        add_overlay(
+            base_image, secrets_dict, logger, tweet_content_dir, BEST_NAME, image_source
+        )
+    return image_source
+
+
+def cut_out_image(
+    survey_url, star_ra, star_dec, logger, base_image, secrets_dict, metrics
+):
+    """Makes the sky image from locally stored HiPS tiles (see hips.py).
+
+    Returns False if that didn't work, so hips2fits can be used instead."""
+    from hips import get_engine
+
+    try:
+        engine = get_engine(
+            secrets_dict["HIPS_TILE_DIR"], secrets_dict.get("HIPS_TILE_BUDGET_MB", 2000)
+        )
+        engine.save(survey_url, star_ra, star_dec, base_image, metrics)
+    except (requests.RequestException, OSError, ValueError, KeyError) as e:
+        logger.warning("Could not make the sky image from tiles: %s", e)
+        return False
+    logger.info("Saved the image made from tiles to %s", base_image)
+    return True
+
+
+def fetch_hips_image(
+    star_ra, star_dec, tweet_content_dir, metrics=None, secrets_dict=None
+):
+    """Downloads the sky image without the overlay.
+
+    With ``HIPS_LOCAL_CUTOUTS`` and a ``HIPS_TILE_DIR`` in ``secrets_dict``
+    the image is made from tiles stored there rather than by hips2fits. Returns the image file and the name
+    of the survey it is from."""
+    if metrics is None:
+        metrics = RunMetrics()
     logger = logging.getLogger("get_images")
 
     base_image = Path.joinpath(tweet_content_dir, "sky_image.jpg")
@@ -105,19 +157,24 @@ def get_hips_image(star_ra, star_dec, BEST_NAME, secrets_dict):
     ]
 
     logger.info("Getting the list of useful HIPS")
-    response = requests.get(
-        url="http://alasky.unistra.fr/MocServer/query",
-        params={
-            "fmt": "json",
-            "RA": star_ra,
-            "DEC": star_dec,
-            "SR": 0.25,
-            "intersect": "enclosed",
-            #                                 "dataproduct_subtype":"color",
-            "fields": ",".join(["ID", "hips_service_url", "obs_title"]),
-            "creator_did": ",".join([f"*{i}*" for i in wanted_surveys]),
-        },
-    )
+    with metrics.stage("get_hips_image.mocserver"):
+        response = throttle.call(
+            "mocserver",
+            throttle.session().get,
+            url="http://alasky.unistra.fr/MocServer/query",
+            params={
+                "fmt": "json",
+                "RA": star_ra,
+                "DEC": star_dec,
+                "SR": 0.25,
+                "intersect": "enclosed",
+                #                                 "dataproduct_subtype":"color",
+                "fields": ",".join(["ID", "hips_service_url", "obs_title"]),
+                "creator_did": ",".join([f"*{i}*" for i in wanted_surveys]),
+            },
+            metrics=metrics,
+        )
+    metrics.add_bytes("mocserver", len(response.content))
     if response.status_code < 400:
         logger.debug("HTTP response: %s", response.status_code)
         avail_hips = response.json()
@@ -125,9 +182,33 @@ def get_hips_image(star_ra, star_dec, BEST_NAME, secrets_dict):
             logger.debug("Possible HIPS options: %s", possible_survey["ID"])
         best_survey = get_best_survey(avail_hips, wanted_surveys, star_dec)
         logger.info("The best ranking survey is: %s", best_survey["ID"])
-        download_image(
-            best_survey["hips_service_url"], star_ra, star_dec, logger, base_image
-        )
+        from_tiles = False
+        if (
+            secrets_dict is not None
+            and secrets_dict.get("HIPS_LOCAL_CUTOUTS", False)
+            and secrets_dict.get("HIPS_TILE_DIR")
+        ):
+            with metrics.stage("get_hips_image.tiles"):
+                from_tiles = cut_out_image(
+                    best_survey["hips_service_url"],
+                    star_ra,
+                    star_dec,
+                    logger,
+                    base_image,
+                    secrets_dict,
+                    metrics,
+                )
+        if not from_tiles:
+            with metrics.stage("get_hips_image.download"):
+                download_image(
+                    best_survey["hips_service_url"],
+                    star_ra,
+                    star_dec,
+                    logger,
+                    base_image,
+                    metrics,
+                )
+            metrics.add_bytes("hips2fits", base_image.stat().st_size)
         del response
     else:
         logger.error("BAD HTTP response: %s", response.status_code)
@@ -136,8 +217,4 @@ def get_hips_image(star_ra, star_dec, BEST_NAME, secrets_dict):
         sys.exit("Did not get list of HIPS. Quitting.")
 
     image_source = " ".join(best_survey["ID"].split("/")[2:])
-    add_overlay(
-        base_image, secrets_dict, logger, tweet_content_dir, BEST_NAME, image_source
-    )
-
-    return image_source
+    return base_image, image_source
@@ -0,0 +1,434 @@
+"""Sky images made from HiPS tiles kept on disk, instead of by hips2fits.
+
+A HiPS survey is cut into tiles, each a square of HEALPix pixels from one
+HEALPix pixel at a lower order. Tiles are downloaded once into a store on
+disk (``root/<survey>/Norder<k>/Dir<d>/Npix<n>.jpg``, as on the HiPS server),
+which is kept under a size budget by deleting the least recently used. A
+cutout works out the sky position of every output pixel of a TAN image at
+once, finds the tile and pixel each one falls in, and copies them over, so
+neighbouring stars are drawn from the same tiles."""
+
+import argparse
+import io
+import json
+import logging
+import logging.config
+import os
+import re
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import astropy.units as u
+import numpy as np
+from astropy.coordinates import SkyCoord
+from astropy_healpix import lonlat_to_healpix
+from PIL import Image
+
+import throttle
+from spatial import FIELD_OF_VIEW_DEG, tan_to_sky
+
+# The size of the image made by get_images.download_image.
+IMAGE_SIZE = 1000
+# The lowest tile order a HiPS has.
+MIN_TILE_ORDER = 3
+# Marks a tile the server doesn't have (outside the survey's footprint).
+MISSING = ".missing"
+
+
+def _compact_bits(values):
+    """Every other bit of ``values``, starting with the lowest, packed together."""
+    values = values & 0x5555555555555555
+    values = (values | (values >> 1)) & 0x3333333333333333
+    values = (values | (values >> 2)) & 0x0F0F0F0F0F0F0F0F
+    values = (values | (values >> 4)) & 0x00FF00FF00FF00FF
+    values = (values | (values >> 8)) & 0x0000FFFF0000FFFF
+    values = (values | (values >> 16)) & 0x00000000FFFFFFFF
+    return values
+
+
+def tile_pixels(lon, lat, tile_order, tile_bits):
+    """The tile and the row and column in it for each position (degrees).
+
+    With tiles ``2 ** tile_bits`` pixels wide, the pixels are HEALPix pixels
+    of order ``tile_order + tile_bits`` in the NESTED scheme. In a JPEG or PNG
+    tile the row is the pixel's HEALPix x and the column its y."""
+    order = tile_order + tile_bits
+    ipix = lonlat_to_healpix(
+        np.asarray(lon) * u.deg, np.asarray(lat) * u.deg, 2**order, order="nested"
+    ).astype(np.int64)
+    tile = ipix >> (2 * tile_bits)
+    mask = (1 << tile_bits) - 1
+    row = _compact_bits(ipix) & mask
+    column = _compact_bits(ipix >> 1) & mask
+    return tile, row, column
+
+
+def tile_order_for(pixel_deg, tile_bits, max_order):
+    """The lowest tile order with HEALPix pixels no bigger than ``pixel_deg``."""
+    for order in range(MIN_TILE_ORDER, max_order + 1):
+        healpix_deg = np.degrees(np.sqrt(np.pi / 3) / 2 ** (order + tile_bits))
+        if healpix_deg <= pixel_deg:
+            return order
+    return max_order
+
+
+class Survey:
+    """The parts of a HiPS ``properties`` file we need."""
+
+    def __init__(self, url, properties):
+        self.url = url.rstrip("/")
+        self.properties = properties
+        self.max_order = int(properties["hips_order"])
+        self.tile_width = int(properties.get("hips_tile_width", 512))
+        self.tile_bits = self.tile_width.bit_length() - 1
+        self.frame = properties.get("hips_frame", "equatorial")
+        formats = properties.get("hips_tile_format", "jpeg").split()
+        if "jpeg" in formats:
+            self.extension = "jpg"
+        elif "png" in formats:
+            self.extension = "png"
+        else:
+            raise ValueError(f"{url} has no colour tiles ({formats})")
+        # e.g. CDS_P_DSS2_color, for the store's directory.
+        self.name = re.sub(
+            r"[^A-Za-z0-9]+", "_", properties.get("ID", self.url.split("//")[-1])
+        )
+
+    @staticmethod
+    def parse_properties(text):
+        properties = {}
+        for line in text.splitlines():
+            if "=" in line and not line.lstrip().startswith("#"):
+                key, value = line.split("=", 1)
+                properties[key.strip()] = value.strip()
+        return properties
+
+    def tile_url(self, order, npix):
+        return (
+            f"{self.url}/Norder{order}/Dir{(npix // 10000) * 10000}"
+            f"/Npix{npix}.{self.extension}"
+        )
+
+    def lonlat(self, ra, dec):
+        """Positions in the survey's own frame."""
+        if self.frame == "equatorial":
+            return ra, dec
+        galactic = SkyCoord(ra * u.deg, dec * u.deg, frame="icrs").galactic
+        return galactic.l.deg, galactic.b.deg
+
+
+class TileStore:
+    """HiPS tiles on disk under ``root``, kept under ``budget_mb``.
+
+    Reading a tile updates its mtime, and the tiles with the oldest are
+    deleted when the store is over budget. Decoded tiles are also kept in
+    memory (the last ``decoded_tiles``) for cutouts of nearby stars."""
+
+    def __init__(self, root, budget_mb=2000, decoded_tiles=64, fetch_threads=8):
+        self.root = Path(root)
+        self.budget_bytes = budget_mb * 1024**2
+        self.decoded_tiles = decoded_tiles
+        # Kept for the life of the store, so each thread's session is reused.
+        self.executor = ThreadPoolExecutor(fetch_threads)
+        self.logger = logging.getLogger("hips")
+        self.lock = threading.Lock()
+        self.decoded = OrderedDict()
+        self.surveys = {}
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.usage_bytes = sum(
+            f.stat().st_size for f in self.root.rglob("Npix*") if f.is_file()
+        )
+        self.stats = {"hits": 0, "misses": 0, "bytes": 0}
+
+    def survey(self, url):
+        """The survey at ``url``, with its properties saved in the store."""
+        url = url.rstrip("/")
+        if url not in self.surveys:
+            key = re.sub(r"[^A-Za-z0-9]+", "_", url.split("//")[-1])
+            properties_file = Path.joinpath(self.root, f"{key}.properties")
+            if properties_file.exists():
+                text = properties_file.read_text(encoding="utf-8")
+            else:
+                response = throttle.call(
+                    "hips_tiles",
+                    throttle.session().get,
+                    f"{url}/properties",
+                    timeout=30,
+                )
+                response.raise_for_status()
+                text = response.text
+                properties_file.write_text(text, encoding="utf-8")
+            self.surveys[url] = Survey(url, Survey.parse_properties(text))
+        return self.surveys[url]
+
+    def path(self, survey, order, npix):
+        return Path.joinpath(
+            self.root,
+            survey.name,
+            f"Norder{order}",
+            f"Dir{(npix // 10000) * 10000}",
+            f"Npix{npix}.{survey.extension}",
+        )
+
+    def _stored(self, survey, order, npix):
+        path = self.path(survey, order, npix)
+        return path.exists() or path.with_name(path.name + MISSING).exists()
+
+    def _download(self, survey, order, npix):
+        """Saves a tile to the store and returns its size."""
+        path = self.path(survey, order, npix)
+        if self._stored(survey, order, npix):
+            return 0
+        response = throttle.call(
+            "hips_tiles",
+            throttle.session().get,
+            survey.tile_url(order, npix),
+            timeout=60,
+        )
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if response.status_code == 404:
+            # Outside the survey's footprint, so don't ask again.
+            path.with_name(path.name + MISSING).touch()
+            return 0
+        response.raise_for_status()
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+        tmp_path.write_bytes(response.content)
+        os.replace(tmp_path, path)
+        with self.lock:
+            self.usage_bytes += len(response.content)
+            self.stats["bytes"] += len(response.content)
+        return len(response.content)
+
+    def fetch(self, survey, order, tiles):
+        """Makes sure ``tiles`` are on disk, downloading the missing ones at once.
+
+        Returns how many were already stored, downloaded, and the bytes downloaded."""
+        needed = [npix for npix in tiles if not self._stored(survey, order, npix)]
+        nbytes = 0
+        if needed:
+            self.logger.info(
+                "Downloading %i %s tiles at order %i", len(needed), survey.name, order
+            )
+            nbytes = sum(
+                self.executor.map(
+                    lambda npix: self._download(survey, order, npix), needed
+                )
+            )
+            self.evict()
+        with self.lock:
+            self.stats["hits"] += len(tiles) - len(needed)
+            self.stats["misses"] += len(needed)
+        return len(tiles) - len(needed), len(needed), nbytes
+
+    def tile(self, survey, order, npix):
+        """The tile as an (width, width, 3) array, or None if there isn't one."""
+        key = (survey.name, order, npix)
+        with self.lock:
+            if key in self.decoded:
+                self.decoded.move_to_end(key)
+                return self.decoded[key]
+        path = self.path(survey, order, npix)
+        try:
+            with Image.open(path) as image:
+                data = np.asarray(image.convert("RGB"))
+            os.utime(path)
+        except FileNotFoundError:
+            data = None
+        with self.lock:
+            self.decoded[key] = data
+            while len(self.decoded) > self.decoded_tiles:
+                self.decoded.popitem(last=False)
+        return data
+
+    def evict(self):
+        """Deletes the least recently used tiles until the store is under budget."""
+        if self.usage_bytes <= self.budget_bytes:
+            return
+        tiles = sorted(
+            (f.stat().st_mtime, f.stat().st_size, f)
+            for f in self.root.rglob("Npix*")
+            if f.is_file() and not f.name.endswith(MISSING)
+        )
+        self.usage_bytes = sum(size for _, size, _ in tiles)
+        for _, size, f in tiles:
+            if self.usage_bytes <= self.budget_bytes * 0.9:
+                break
+            try:
+                f.unlink()
+            except FileNotFoundError:
+                pass
+            self.usage_bytes -= size
+        self.logger.info("Tile store is now %.0f MB", self.usage_bytes / 1024**2)
+
+
+class CutoutEngine:
+    """Makes the same TAN images as hips2fits from a TileStore.
+
+    North is up and east is left, ``fov_deg`` across ``size`` pixels."""
+
+    def __init__(self, store, size=IMAGE_SIZE, fov_deg=FIELD_OF_VIEW_DEG):
+        self.store = store
+        self.size = size
+        self.fov_deg = fov_deg
+        self.pixel_deg = fov_deg / size
+        # Tangent plane offsets (degrees) of the output pixel centres.
+        offsets = (np.arange(size) - (size - 1) / 2) * self.pixel_deg
+        self.xi = -offsets[np.newaxis, :].repeat(size, axis=0)
+        self.eta = -offsets[:, np.newaxis].repeat(size, axis=1)
+
+    def cutout(self, survey_url, ra, dec, metrics=None):
+        """The image centred on (ra, dec) as a (size, size, 3) uint8 array."""
+        survey = self.store.survey(survey_url)
+        order = tile_order_for(self.pixel_deg, survey.tile_bits, survey.max_order)
+        lon, lat = survey.lonlat(*tan_to_sky(ra, dec, self.xi, self.eta))
+        tile, row, column = tile_pixels(
+            lon.ravel(), lat.ravel(), order, survey.tile_bits
+        )
+        tiles, inverse = np.unique(tile, return_inverse=True)
+        hits, misses, nbytes = self.store.fetch(survey, order, tiles.tolist())
+        if metrics is not None:
+            metrics.add_bytes("hips_tiles", nbytes)
+            metrics.merge({"cache": {"hips_tiles": {"hits": hits, "misses": misses}}})
+        image = np.zeros((self.size * self.size, 3), dtype=np.uint8)
+        # Sort the output pixels by tile so each tile is one contiguous block.
+        by_tile = np.argsort(inverse, kind="stable")
+        starts = np.searchsorted(inverse[by_tile], np.arange(len(tiles) + 1))
+        for k, npix in enumerate(tiles):
+            data = self.store.tile(survey, order, int(npix))
+            if data is None:
+                continue
+            pixels = by_tile[starts[k] : starts[k + 1]]
+            image[pixels] = data[row[pixels], column[pixels]]
+        return image.reshape(self.size, self.size, 3)
+
+    def save(self, survey_url, ra, dec, out_file, metrics=None):
+        Image.fromarray(self.cutout(survey_url, ra, dec, metrics)).save(out_file)
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_engine(tile_dir, budget_mb=2000):
+    """One CutoutEngine per tile store per process, so decoded tiles are shared."""
+    key = str(Path(tile_dir).resolve())
+    with _engines_lock:
+        if key not in _engines:
+            _engines[key] = CutoutEngine(TileStore(tile_dir, budget_mb))
+        return _engines[key]
+
+
+def compare(image, reference):
+    """Mean and 99th percentile absolute difference of two uint8 RGB images."""
+    difference = np.abs(image.astype(np.int16) - reference.astype(np.int16))
+    return float(difference.mean()), float(np.percentile(difference, 99))
+
+
+def _hips2fits(survey_url, ra, dec, size, fov_deg):
+    response = throttle.call(
+        "hips2fits",
+        throttle.session().get,
+        url="http://alasky.u-strasbg.fr/hips-image-services/hips2fits",
+        params={
+            "hips": survey_url,
+            "width": size,
+            "height": size,
+            "fov": fov_deg,
+            "projection": "TAN",
+            "coordsys": "icrs",
+            "ra": ra,
+            "dec": dec,
+            "format": "jpg",
+            "stretch": "linear",
+        },
+        timeout=120,
+    )
+    response.raise_for_status()
+    return np.asarray(Image.open(io.BytesIO(response.content)).convert("RGB"))
+
+
+def main():
+    logging.config.fileConfig(Path.joinpath(Path(__file__).parent, "logging.conf"))
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("tile_dir", help="Where the tiles are kept.")
+    parser.add_argument("survey_url", help="The HiPS, e.g. its hips_service_url.")
+    parser.add_argument(
+        "positions",
+        help="A file with a name, RA and Dec (degrees) on each line.",
+    )
+    parser.add_argument("out_dir", help="Where to save <name>.jpg for each position.")
+    parser.add_argument("--budget_mb", type=int, default=2000)
+    parser.add_argument(
+        "--size", help="Width of the images in pixels.", type=int, default=IMAGE_SIZE
+    )
+    parser.add_argument(
+        "--compare",
+        help="Also get each image from hips2fits and print how different they are.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--record",
+        help=(
+            "Also save each hips2fits image as <name>.hips2fits.png and the "
+            "positions in fixture.json, for tests/test_hips.py."
+        ),
+        action="store_true",
+    )
+    args = parser.parse_args()
+
+    engine = CutoutEngine(TileStore(args.tile_dir, args.budget_mb), args.size)
+    survey = engine.store.survey(args.survey_url)
+    order = tile_order_for(engine.pixel_deg, survey.tile_bits, survey.max_order)
+    positions = []
+    with open(args.positions) as f:
+        for line in f:
+            if line.strip() and not line.startswith("#"):
+                name, ra, dec = line.split()[:3]
+                positions.append((name, float(ra), float(dec)))
+    # Neighbouring stars one after the other, so they share decoded tiles.
+    lon, lat = survey.lonlat(
+        np.array([p[1] for p in positions]), np.array([p[2] for p in positions])
+    )
+    tiles, *_ = tile_pixels(lon, lat, order, survey.tile_bits)
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    started = time.perf_counter()
+    for i in np.argsort(tiles, kind="stable"):
+        name, ra, dec = positions[i]
+        image = engine.cutout(args.survey_url, ra, dec)
+        Image.fromarray(image).save(Path.joinpath(out_dir, f"{name}.jpg"))
+        if args.compare or args.record:
+            reference = _hips2fits(
+                args.survey_url, ra, dec, engine.size, engine.fov_deg
+            )
+            mean, p99 = compare(image, reference)
+            print(f"{name}: mean difference {mean:.1f}, 99th percentile {p99:.0f}")
+            if args.record:
+                Image.fromarray(reference).save(
+                    Path.joinpath(out_dir, f"{name}.hips2fits.png")
+                )
+    if args.record:
+        fixture = {
+            "survey_url": args.survey_url,
+            "tile_dir": os.path.relpath(args.tile_dir, out_dir),
+            "size": engine.size,
+            "fov_deg": engine.fov_deg,
+            "positions": positions,
+        }
+        Path.joinpath(out_dir, "fixture.json").write_text(
+            json.dumps(fixture, indent=1), encoding="utf-8"
+        )
+    print(
+        f"Made {len(positions)} images in {time.perf_counter() - started:.1f} s, "
+        f"{engine.store.stats['misses']} tiles downloaded, "
+        f"{engine.store.stats['hits']} already stored"
+    )
+
+
+if __name__ == "__main__":
+    main()
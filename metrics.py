@@ -0,0 +1,169 @@
+"""Per-stage timing and resource metrics for a run of the bot."""
+
+import cProfile
+import json
+import logging
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+
+PROFILERS = ["cprofile", "pyinstrument"]
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB, over its whole life."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS but kilobytes on Linux.
+    if sys.platform == "darwin":
+        return peak / 1024**2
+    return peak / 1024
+
+
+def rss_mb():
+    """Current resident set size of this process in MB, or None if unknown."""
+    try:
+        with open("/proc/self/statm") as f:
+            resident_pages = int(f.read().split()[1])
+    except OSError:
+        return None
+    return resident_pages * resource.getpagesize() / 1024**2
+
+
+def _round(mb):
+    return None if mb is None else round(mb, 1)
+
+
+class RunMetrics:
+    """Collects stage durations, bytes transferred and cache hits for one run.
+
+    Stages are named with dots for sub-stages, e.g. ``get_hips_image.download``.
+    If ``profile_stage`` matches a stage name, that stage is run under cProfile
+    (or pyinstrument, if asked for and installed) and the profile is saved to
+    ``profile_dir``.
+
+    The resident set size is recorded at the start and end of the run; the
+    peak is the whole process's, so in daemon mode it covers earlier runs too."""
+
+    def __init__(self, profile_stage=None, profiler="cprofile", profile_dir=None):
+        self.run_id = datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S%fZ")
+        self.started = datetime.now(timezone.utc).isoformat()
+        self.stages = {}
+        self.bytes_transferred = {}
+        self.cache = {}
+        self.info = {}
+        self.status = "running"
+        self.profile_stage = profile_stage
+        self.profiler = profiler
+        if profile_dir is None:
+            profile_dir = Path.joinpath(Path(__file__).parent, "profiles")
+        self.profile_dir = Path(profile_dir)
+        self._t0 = time.perf_counter()
+        self.rss_start_mb = rss_mb()
+
+    @contextmanager
+    def stage(self, name):
+        """Time the enclosed block and add it to the named stage."""
+        logger = logging.getLogger("metrics")
+        profiler = self._start_profiler(name)
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                self._stop_profiler(name, profiler)
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+            logger.debug("Stage %s took %0.3f s", name, elapsed)
+
+    @contextmanager
+    def recording(self, metrics_file):
+        """Set the run status from how the block ends, then write the record."""
+        try:
+            yield self
+        except SystemExit as e:
+            # The bot quits with sys.exit("message") when something goes wrong.
+            self.status = "ok" if e.code in (None, 0) else "failed"
+            raise
+        except BaseException:
+            self.status = "error"
+            raise
+        else:
+            self.status = "ok"
+        finally:
+            self.write(metrics_file)
+            logging.getLogger("metrics").info("Wrote run metrics to %s", metrics_file)
+
+    def add_bytes(self, name, nbytes):
+        """Count bytes transferred to or from an upstream service."""
+        self.bytes_transferred[name] = self.bytes_transferred.get(name, 0) + int(nbytes)
+
+    def cache_lookup(self, name, hit):
+        """Count a hit or a miss for the named cache."""
+        counts = self.cache.setdefault(name, {"hits": 0, "misses": 0})
+        counts["hits" if hit else "misses"] += 1
+
+    def merge(self, other):
+        """Fold in a metrics dictionary produced elsewhere (e.g. a worker)."""
+        for name, seconds in other.get("stages", {}).items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+        for name, nbytes in other.get("bytes_transferred", {}).items():
+            self.add_bytes(name, nbytes)
+        for name, counts in other.get("cache", {}).items():
+            mine = self.cache.setdefault(name, {"hits": 0, "misses": 0})
+            mine["hits"] += counts["hits"]
+            mine["misses"] += counts["misses"]
+        self.info.update(other.get("info", {}))
+
+    def as_dict(self):
+        return {
+            "run_id": self.run_id,
+            "started": self.started,
+            "status": self.status,
+            "total_s": round(time.perf_counter() - self._t0, 4),
+            "stages_s": {k: round(v, 4) for k, v in self.stages.items()},
+            "bytes_transferred": self.bytes_transferred,
+            "cache": self.cache,
+            "rss_start_mb": _round(self.rss_start_mb),
+            "rss_end_mb": _round(rss_mb()),
+            "process_peak_rss_mb": round(peak_rss_mb(), 1),
+            "info": self.info,
+        }
+
+    def write(self, metrics_file):
+        """Append this run as one JSON line to ``metrics_file``."""
+        with open(metrics_file, "a", encoding="utf-8") as f:
+            f.write(json.dumps(self.as_dict(), default=str) + "\n")
+
+    def _start_profiler(self, name):
+        if name != self.profile_stage:
+            return None
+        if self.profiler == "pyinstrument":
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                logging.getLogger("metrics").warning(
+                    "pyinstrument is not installed, using cProfile instead"
+                )
+            else:
+                profiler = Profiler()
+                profiler.start()
+                return profiler
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def _stop_profiler(self, name, profiler):
+        logger = logging.getLogger("metrics")
+        self.profile_dir.mkdir(parents=True, exist_ok=True)
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+            out_file = Path.joinpath(self.profile_dir, f"{self.run_id}_{name}.prof")
+            profiler.dump_stats(out_file)
+        else:
+            profiler.stop()
+            out_file = Path.joinpath(self.profile_dir, f"{self.run_id}_{name}.html")
+            out_file.write_text(profiler.output_html(), encoding="utf-8")
+        logger.info("Saved profile of %s to %s", name, out_file)
@@ -1,13 +1,13 @@
+import io
 import logging
-import logging.config
 import sys
+from functools import lru_cache
 from pathlib import Path
 
 import astropy.units as u
 import galah_plotting
 import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
 from astropy.constants import c
 from astropy.io import fits
 from matplotlib import rcParams
@@ -15,42 +15,119 @@ from matplotlib.offsetbox import AnchoredText
 from pyvo.dal.exceptions import DALFormatError, DALServiceError
 from pyvo.dal.ssa import SSAService
 
+import throttle
+from metrics import RunMetrics
+from spectra_index import SpectraIndex
+
 # URL of the SSA service
 URL = "https://datacentral.org.au/vo/ssa/query"
 service = SSAService(URL)
 
 
-def plot_spectra(sobject_id, rv_galah, BEST_NAME):
+def fetch_spectrum(url, logger, metrics):
+    """Downloads one FITS spectrum and returns the opened HDUList."""
+    logger.info("Opening %s", url)
+    with metrics.stage("plot_spectra.fits_fetch"):
+        response = throttle.call(
+            "datacentral", throttle.session().get, url, metrics=metrics
+        )
+    if response.status_code >= 400:
+        logger.error("BAD HTTP response: %s", response.status_code)
+        logger.error("Did not get the spectrum. Quitting.")
+        sys.exit("Did not get the spectrum. Quitting.")
+    metrics.add_bytes("datacentral_fits", len(response.content))
+    return fits.open(io.BytesIO(response.content))
+
 
+def set_style():
     rcParams["font.family"] = "sans-serif"
     rcParams["font.sans-serif"] = ["Roboto"]
     rcParams["figure.facecolor"] = "white"
     plt.style.use("dark_background")
 
-    cwd = Path(__file__).parent
-    tweet_content_dir = Path.joinpath(cwd, "tweet_content")
-    config_file = Path.joinpath(cwd, "logging.conf")
-    logging.config.fileConfig(config_file)
-    # create logger
+
+def plot_spectra(
+    sobject_id, rv_galah, BEST_NAME, tweet_content_dir, metrics=None, index_file=None
+):
+    if metrics is None:
+        metrics = RunMetrics()
+
+    set_style()
+
+    spectra = fetch_spectra(sobject_id, metrics, index_file)
     logger = logging.getLogger("plot_spectra")
+    with metrics.stage("plot_spectra.render"):
+        render_spectra(spectra, rv_galah, BEST_NAME, tweet_content_dir, logger)
+    return 0
+
 
+def search_spectra(sobject_id, metrics=None):
+    """The SSA search for one star's normalised spectra, as a DataFrame."""
     custom = {}
     custom["TARGETNAME"] = sobject_id
     # only retrieve the normalised spectra
     custom["DPSUBTYPE"] = "normalised"
     custom["COLLECTION"] = "galah_dr3"
-    logger.info("Grabbing the spectra files")
-    try:
-        results = service.search(**custom)
-    except (DALServiceError, DALFormatError) as e:
-        logger.error(e)
-        logger.error("Did not get the list of spectra. Quitting.")
-        sys.exit("Did not get the list of spectra. Quitting.")
-    indiv_results = []
-    indiv_results.append(
+    results = throttle.call("datacentral", service.search, metrics=metrics, **custom)
+    return (
         results.votable.get_first_table().to_table(use_names_over_ids=True).to_pandas()
     )
 
+
+@lru_cache(maxsize=None)
+def open_index(index_file):
+    """``index_file`` opened read-only, or None if there isn't one."""
+    if not Path(index_file).is_file():
+        logging.getLogger("plot_spectra").warning(
+            "No spectra index at %s, so searching for every star", index_file
+        )
+        return None
+    return SpectraIndex(index_file, read_only=True)
+
+
+def fetch_spectra(sobject_id, metrics=None, index_file=None):
+    """Downloads the spectra. Returns a dict of band name to wavelength and flux.
+
+    The spectra are looked up in ``index_file`` (see spectra_index.py) if the
+    star was searched for when it was made, and by an SSA search if not."""
+    if metrics is None:
+        metrics = RunMetrics()
+
+    logger = logging.getLogger("plot_spectra")
+
+    df = None
+    index = open_index(str(index_file)) if index_file else None
+    if index is not None:
+        with metrics.stage("plot_spectra.index_lookup"):
+            df = index.lookup(sobject_id)
+        metrics.cache_lookup("spectra_index", df is not None)
+    if df is None:
+        logger.info("Grabbing the spectra files")
+        try:
+            with metrics.stage("plot_spectra.ssa_search"):
+                df = search_spectra(sobject_id, metrics)
+        except (DALServiceError, DALFormatError) as e:
+            logger.error(e)
+            logger.error("Did not get the list of spectra. Quitting.")
+            sys.exit("Did not get the list of spectra. Quitting.")
+    else:
+        logger.info("Found %i spectra in %s", len(df), index_file)
+
+    spectra = {}
+    for *_, spec_row in df.iterrows():
+        url = spec_row["access_url"] + "&RESPONSEFORMAT=fits"
+        with fetch_spectrum(url, logger, metrics) as spec:
+            wl = np.linspace(
+                float(spec[0].header["WMIN"]),
+                float(spec[0].header["WMAX"]),
+                len(spec[0].data),
+            )
+            spectra[spec_row["band_name"]] = (wl, np.array(spec[0].data))
+    return spectra
+
+
+def render_spectra(spectra, rv_galah, BEST_NAME, tweet_content_dir, logger):
+    """Plots the spectra (a dict of band name to wavelength and flux)."""
     bands_names = ["B", "V", "R", "I"]
 
     band_dict = {
@@ -60,12 +137,8 @@ def plot_spectra(sobject_id, rv_galah, BEST_NAME):
         "I": {"color": "C2", "ticks": np.arange(7610, 7900, 75), "name": "infrared"},
     }
 
-    df = pd.concat(indiv_results, ignore_index=True)
-
     plot_list_base = [[i] for i in ["B", "V", "R", "I"]]
 
-    rv_correction = (c / ((rv_galah * u.km / u.s) + c)).decompose().value
-
     fig, axes, redo_axes_list, *_ = galah_plotting.initialize_plots(
         figsize=(3, 4),
         #     things_to_plot=plot_list_base,
@@ -79,25 +152,17 @@ def plot_spectra(sobject_id, rv_galah, BEST_NAME):
         rv_correction = (c / ((rv_galah * u.km / u.s) + c)).decompose().value
         logger.debug("Applying an RV correction of %s", rv_correction)
 
-    for *_, spec_row in df.iterrows():
-        url = spec_row["access_url"] + "&RESPONSEFORMAT=fits"
-        logger.info("Opening %s", url)
-        with fits.open(url) as spec:
-            wl = np.linspace(
-                float(spec[0].header["WMIN"]),
-                float(spec[0].header["WMAX"]),
-                len(spec[0].data),
-            )
-            axes[spec_row["band_name"]].plot(
-                wl * rv_correction,
-                spec[0].data,
-                c=band_dict[spec_row["band_name"]]["color"],
-                lw=0.5,
-            )
+    for band_name, (wl, flux) in spectra.items():
+        axes[band_name].plot(
+            wl * rv_correction,
+            flux,
+            c=band_dict[band_name]["color"],
+            lw=0.5,
+        )
 
-        redo_axes_list[spec_row["band_name"]].update(
+        redo_axes_list[band_name].update(
             {
-                "xticks": band_dict[spec_row["band_name"]]["ticks"],
+                "xticks": band_dict[band_name]["ticks"],
                 "yticks": [],
                 "xlim": np.percentile(wl, [0, 100]) + [-3, 3],
                 "ylim": [0, 1.2],
@@ -112,9 +177,7 @@ def plot_spectra(sobject_id, rv_galah, BEST_NAME):
 
     axes["B"].set_title(f"Normalized HERMES spectrum of\n{BEST_NAME}")
 
-    for missing_band in [
-        band for band in bands_names if band not in df["band_name"].to_list()
-    ]:
+    for missing_band in [band for band in bands_names if band not in spectra]:
         redo_axes_list[missing_band].update(
             {"xticks": [], "yticks": [], "ylim": [0, 1.2]}
         )
@@ -132,4 +195,4 @@ def plot_spectra(sobject_id, rv_galah, BEST_NAME):
     spec_file = Path.joinpath(tweet_content_dir, "spectra.png")
     logger.info("Saving spectrum to %s", spec_file)
     fig.savefig(spec_file, bbox_inches="tight", dpi=500, transparent=False)
-    return 0
+    plt.close(fig)
@@ -0,0 +1,204 @@
+"""Which of the eligible stars have already been tweeted.
+
+The history is one bit per eligible star, memory-mapped from a small file,
+so checking a star is O(1) and opening it costs nothing however big the
+catalogue is. Updates take an exclusive lock on a ``.lock`` file next to it,
+so several processes can draw stars at the same time without tweeting the
+same one twice. Each version of the catalogue has its own file (named with
+its fingerprint), so processes on different versions, e.g. while the daemon
+reloads, don't reset each other's history."""
+
+import fcntl
+import hashlib
+import logging
+import os
+import struct
+from collections import namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+
+import numpy as np
+
+MAGIC = b"RGPOSTED"
+# magic, epoch, number of eligible stars, catalogue fingerprint, number posted
+HEADER = struct.Struct("<8sIQ8sQ")
+HEADER_SIZE = 64
+Header = namedtuple("Header", ["epoch", "n", "fingerprint", "count"])
+
+
+def fingerprint(sobject_ids):
+    """A short hash of the eligible stars, to notice a changed catalogue."""
+    ids = np.ascontiguousarray(sobject_ids, dtype=np.int64)
+    return hashlib.blake2b(ids.tobytes(), digest_size=8).digest()
+
+
+class PostedHistory:
+    """Bit ``i`` is set once the ``i``-th eligible star has been tweeted.
+
+    ``sobject_ids`` are the eligible stars in catalogue order, and the
+    history is kept in ``path`` with their fingerprint added to the name
+    (``posted_history.bin`` becomes ``posted_history.<fingerprint>.bin``), so
+    a new catalogue starts a new history. When every star has been tweeted,
+    a new epoch starts with nothing posted."""
+
+    def __init__(self, path, sobject_ids):
+        self.n = len(sobject_ids)
+        self.fingerprint = fingerprint(sobject_ids)
+        path = Path(path)
+        self.path = path.with_name(f"{path.stem}.{self.fingerprint.hex()}{path.suffix}")
+        self.lock_path = self.path.with_name(self.path.name + ".lock")
+        self.logger = logging.getLogger("posted_history")
+        self.rng = np.random.default_rng()
+        with self._locked():
+            header = self._read_header()
+            if header is None and self._adopt(path):
+                header = self._read_header()
+            if header is None:
+                self._reset(0)
+            elif not self._matches(header):
+                self.logger.warning("%s is for another catalogue, replacing it", path)
+                self._reset(header.epoch + 1)
+            self._open()
+
+    def _adopt(self, old_path):
+        """Copies a history from before files were named by fingerprint."""
+        try:
+            with open(old_path, "rb") as f:
+                data = f.read()
+            magic, *header = HEADER.unpack(data[: HEADER.size])
+        except (FileNotFoundError, struct.error):
+            return False
+        if magic != MAGIC or not self._matches(Header(*header)):
+            return False
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, self.path)
+        self.logger.info("Carrying on the history in %s", old_path)
+        return True
+
+    def _matches(self, header):
+        return header.n == self.n and header.fingerprint == self.fingerprint
+
+    @contextmanager
+    def _locked(self):
+        with open(self.lock_path, "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _read_header(self):
+        try:
+            with open(self.path, "rb") as f:
+                magic, *header = HEADER.unpack(f.read(HEADER.size))
+        except (FileNotFoundError, struct.error):
+            return None
+        if magic != MAGIC:
+            return None
+        return Header(*header)
+
+    def _write_header(self, epoch, count):
+        with open(self.path, "r+b") as f:
+            f.write(HEADER.pack(MAGIC, epoch, self.n, self.fingerprint, count))
+
+    def _reset(self, epoch):
+        """Starts epoch ``epoch`` with no stars posted. Call with the lock held."""
+        self.logger.info("Starting posting history epoch %i at %s", epoch, self.path)
+        size = HEADER_SIZE + (self.n + 7) // 8
+        header = HEADER.pack(MAGIC, epoch, self.n, self.fingerprint, 0)
+        if self.path.exists() and self.path.stat().st_size == size:
+            # Clear the bits in place, as other processes may have them mapped.
+            with open(self.path, "r+b") as f:
+                f.write(header.ljust(HEADER_SIZE, b"\0"))
+                f.write(bytes(size - HEADER_SIZE))
+            return
+        # Never truncate a file that may be mapped; put a new one in its place.
+        tmp_path = self.path.with_name(f"{self.path.name}.{os.getpid()}.tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(header.ljust(HEADER_SIZE, b"\0"))
+            f.write(bytes(size - HEADER_SIZE))
+        os.replace(tmp_path, self.path)
+
+    def _open(self):
+        header = self._read_header()
+        self.epoch, self.count = header.epoch, header.count
+        self.bits = np.memmap(
+            self.path,
+            dtype=np.uint8,
+            mode="r+",
+            offset=HEADER_SIZE,
+            shape=((self.n + 7) // 8,),
+        )
+
+    def _refresh(self):
+        """Picks up a reset or claims done by another process. Lock held."""
+        header = self._read_header()
+        if header is None or not self._matches(header):
+            # The file is named for our catalogue, so this is damage, not a reload.
+            raise RuntimeError(f"{self.path} has been changed by something else")
+        self.epoch, self.count = header.epoch, header.count
+
+    def posted(self, i):
+        return bool(self.bits[i >> 3] & (1 << (i & 7)))
+
+    @property
+    def remaining(self):
+        return self.n - self.count
+
+    def posted_mask(self):
+        """A boolean array, True for each eligible star already tweeted."""
+        return np.unpackbits(self.bits, count=self.n, bitorder="little").astype(bool)
+
+    def unposted(self):
+        """Positions (in the eligible stars) of everything not yet tweeted."""
+        return np.flatnonzero(~self.posted_mask())
+
+    def claim(self, i):
+        """Marks star ``i`` as tweeted. False if it already was."""
+        with self._locked():
+            self._refresh()
+            if self.posted(i):
+                return False
+            self.bits[i >> 3] |= np.uint8(1 << (i & 7))
+            self.bits.flush()
+            self.count += 1
+            self._write_header(self.epoch, self.count)
+            return True
+
+    def release(self, i, epoch):
+        """Unmarks star ``i``, claimed in ``epoch``, when its tweet didn't happen."""
+        with self._locked():
+            self._refresh()
+            if self.epoch != epoch or not self.posted(i):
+                return False
+            self.bits[i >> 3] &= np.uint8(~(1 << (i & 7)) & 0xFF)
+            self.bits.flush()
+            self.count -= 1
+            self._write_header(self.epoch, self.count)
+            return True
+
+    def new_epoch(self):
+        with self._locked():
+            header = self._read_header()
+            self._reset(0 if header is None else header.epoch + 1)
+            self._open()
+
+    def draw(self, max_tries=32):
+        """Claims and returns a random star that hasn't been tweeted.
+
+        Random guesses are cheap while most stars are unposted; after
+        ``max_tries`` misses we pick from the full list of unposted stars."""
+        for _ in range(max_tries):
+            i = int(self.rng.integers(self.n))
+            if not self.posted(i) and self.claim(i):
+                return i
+        while True:
+            candidates = self.unposted()
+            if len(candidates) == 0:
+                self.logger.info("Every eligible star has been tweeted")
+                self.new_epoch()
+                continue
+            i = int(self.rng.choice(candidates))
+            if self.claim(i):
+                return i
@@ -0,0 +1,252 @@
+"""Draws the images for a tweet in worker processes, at the same time.
+
+The two stellar parameter figures, the spectra and the sky image overlay are
+each CPU-bound, so with a pool they take about as long as the slowest one,
+and the stellar parameter figures are drawn while the sky image and spectra
+are still downloading. The catalogue columns the plots need are written once
+per catalogue to memory-mapped .npy files (in /dev/shm where there is one)
+that every worker maps, so the catalogue is never pickled or copied."""
+
+import json
+import logging
+import logging.config
+import multiprocessing
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from catalogue import FLOAT32_COLUMNS
+
+# The worker's view of the shared catalogue: (export_dir, galah_dr3, basest_idx_galah).
+_attached = None
+
+
+def export_columns(galah_dr3, basest_idx_galah, export_dir):
+    """Writes the plotted columns and the basic cuts to ``export_dir``.
+
+    The columns go in one (stars, columns) float32 array in Fortran order, so
+    each column is contiguous and a DataFrame can be made from it without
+    copying."""
+    export_dir = Path(export_dir)
+    columns = [column for column in FLOAT32_COLUMNS if column in galah_dr3]
+    values = np.lib.format.open_memmap(
+        Path.joinpath(export_dir, "columns.npy"),
+        mode="w+",
+        dtype=np.float32,
+        shape=(len(galah_dr3), len(columns)),
+        fortran_order=True,
+    )
+    for i, column in enumerate(columns):
+        values[:, i] = galah_dr3[column].to_numpy()
+    values.flush()
+    del values
+    np.save(
+        Path.joinpath(export_dir, "basest_idx_galah.npy"),
+        basest_idx_galah.to_numpy(dtype=bool),
+    )
+    Path.joinpath(export_dir, "columns.json").write_text(
+        json.dumps(columns), encoding="utf-8"
+    )
+
+
+def attach(export_dir):
+    """The shared catalogue, mapped the first time a worker needs it."""
+    global _attached
+    if _attached is None or _attached[0] != export_dir:
+        export_dir = str(export_dir)
+        columns = json.loads(
+            Path.joinpath(Path(export_dir), "columns.json").read_text(encoding="utf-8")
+        )
+        values = np.load(Path.joinpath(Path(export_dir), "columns.npy"), mmap_mode="r")
+        galah_dr3 = pd.DataFrame(values, columns=columns, copy=False)
+        basest_idx_galah = pd.Series(
+            np.load(
+                Path.joinpath(Path(export_dir), "basest_idx_galah.npy"), mmap_mode="r"
+            ),
+            index=galah_dr3.index,
+        )
+        _attached = (export_dir, galah_dr3, basest_idx_galah)
+    return _attached[1], _attached[2]
+
+
+def _init_worker():
+    logging.config.fileConfig(Path.joinpath(Path(__file__).parent, "logging.conf"))
+
+
+def _timed(function, *args):
+    started = time.perf_counter()
+    function(*args)
+    return time.perf_counter() - started
+
+
+def _stellar_params_figure(
+    export_dir, star_row, the_star, BEST_NAME, tweet_content_dir, plot_list_base
+):
+    from plot_stellar_params import plot_figure, set_style
+
+    galah_dr3, basest_idx_galah = attach(export_dir)
+    star_idx = np.zeros(len(galah_dr3), dtype=bool)
+    star_idx[star_row] = True
+    set_style()
+    plot_figure(
+        galah_dr3,
+        the_star,
+        BEST_NAME,
+        basest_idx_galah,
+        tweet_content_dir,
+        plot_list_base,
+        pd.Series(star_idx, index=galah_dr3.index),
+    )
+
+
+def _overlay(base_image, secrets_dict, tweet_content_dir, BEST_NAME, image_source):
+    from get_images import add_overlay
+
+    add_overlay(
+        base_image,
+        secrets_dict,
+        logging.getLogger("get_images"),
+        tweet_content_dir,
+        BEST_NAME,
+        image_source,
+    )
+
+
+def _spectra(spectra, rv_galah, BEST_NAME, tweet_content_dir):
+    from plot_spectra import render_spectra, set_style
+
+    set_style()
+    render_spectra(
+        spectra,
+        rv_galah,
+        BEST_NAME,
+        tweet_content_dir,
+        logging.getLogger("plot_spectra"),
+    )
+
+
+class RenderPool:
+    """A pool of ``workers`` processes for drawing images.
+
+    ``share(catalogue)`` exports the catalogue for the workers (once per
+    loaded catalogue) and ``jobs()`` starts a set of renders for one tweet."""
+
+    def __init__(self, workers=4):
+        self.workers = workers
+        # Not fork: the daemon has other threads running.
+        self.executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_worker,
+        )
+        self.exports = {}
+        self.lock = threading.Lock()
+        self.logger = logging.getLogger("render_pool")
+        shm = Path("/dev/shm")
+        self.tmp_root = str(shm) if shm.is_dir() else None
+
+    def share(self, catalogue):
+        """The directory the workers find ``catalogue``'s columns in."""
+        key = (str(catalogue.path), catalogue.mtime, id(catalogue.galah_dr3))
+        with self.lock:
+            if key not in self.exports:
+                export_dir = tempfile.mkdtemp(prefix="robot_galah_", dir=self.tmp_root)
+                export_columns(
+                    catalogue.galah_dr3, catalogue.basest_idx_galah, export_dir
+                )
+                self.logger.info("Exported the catalogue to %s", export_dir)
+                # Keep the previous one for renders that are already queued.
+                for old_key in list(self.exports)[:-1]:
+                    shutil.rmtree(self.exports.pop(old_key), ignore_errors=True)
+                self.exports[key] = export_dir
+            return self.exports[key]
+
+    def jobs(self):
+        return RenderJobs(self)
+
+    def close(self):
+        self.executor.shutdown()
+        with self.lock:
+            for export_dir in self.exports.values():
+                shutil.rmtree(export_dir, ignore_errors=True)
+            self.exports = {}
+
+
+class RenderJobs:
+    """The renders for one tweet. ``wait`` records how long each one took."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.futures = {}
+
+    def submit(self, name, function, *args):
+        self.futures[name] = self.pool.executor.submit(_timed, function, *args)
+
+    def stellar_params(
+        self, catalogue, star_row, the_star, BEST_NAME, tweet_content_dir
+    ):
+        from plot_stellar_params import PLOT_LIST_BASES
+
+        export_dir = self.pool.share(catalogue)
+        for plot_list_base in PLOT_LIST_BASES:
+            self.submit(
+                f"plot_stellar_params.{plot_list_base[0][0]}",
+                _stellar_params_figure,
+                export_dir,
+                star_row,
+                the_star,
+                BEST_NAME,
+                tweet_content_dir,
+                plot_list_base,
+            )
+
+    def overlay(
+        self, base_image, secrets_dict, tweet_content_dir, BEST_NAME, image_source
+    ):
+        self.submit(
+            "get_hips_image.overlay",
+            _overlay,
+            base_image,
+            secrets_dict,
+            tweet_content_dir,
+            BEST_NAME,
+            image_source,
+        )
+
+    def spectra(self, spectra, rv_galah, BEST_NAME, tweet_content_dir):
+        self.submit(
+            "plot_spectra.render",
+            _spectra,
+            spectra,
+            rv_galah,
+            BEST_NAME,
+            tweet_content_dir,
+        )
+
+    def cancel(self):
+        """Stops the renders that haven't started and waits for the rest."""
+        for future in self.futures.values():
+            future.cancel()
+        for future in self.futures.values():
+            if not future.cancelled():
+                future.exception()
+        self.futures = {}
+
+    def wait(self, metrics):
+        """Waits for every render, then raises the first error if there was one."""
+        error = None
+        for name, future in self.futures.items():
+            try:
+                metrics.merge({"stages": {name: future.result()}})
+            except BaseException as e:
+                if error is None:
+                    error = e
+        self.futures = {}
+        if error is not None:
+            raise error
@@ -1,24 +1,35 @@
 """Bot for GALAH."""
 
 import argparse
+import atexit
 import json
 import logging
 import logging.config
 import sys
+import threading
 import warnings
 from datetime import datetime
 from pathlib import Path
 from random import choice
 
-import pandas as pd
 import numpy as np
+import pandas as pd
 from astroquery.exceptions import TableParseError
 from astroquery.simbad import Simbad
 
+from catalogue import Catalogue
+from daemon import Daemon
 from do_the_tweeting import tweet
-from get_images import get_hips_image
-from plot_spectra import plot_spectra
+from get_images import add_overlay, fetch_hips_image
+from metrics import PROFILERS, RunMetrics
+from plot_spectra import fetch_spectra, render_spectra
+from plot_spectra import set_style as set_spectra_style
 from plot_stellar_params import plot_stellar_params
+from render_pool import RenderPool
+import throttle
+from sampler import STRATIFICATIONS, UnknownStratumError, parse_weights
+from staging import Stager, StagingQueue
+from workdir import CLEANUP_POLICIES, sweep, work_dir
 from astroquery.simbad import Simbad
 import astropy.coordinates as coord
 import astropy.units as u
@@ -176,6 +187,7 @@ def get_secrets(cwd, logger):
     logger.debug("Getting the Twitter secrets from %s", SECRETS_FILE)
     try:
         keys = get_keys(SECRETS_FILE)
+        throttle.configure(keys)
         return keys
     except FileNotFoundError as e:
         logger.error(e)
@@ -183,40 +195,90 @@ def get_secrets(cwd, logger):
         sys.exit("Did not load secrets file. Quitting.")
 
 
-def simbad_sky_search(ra, dec):
-    return Simbad.query_region(
-        coord.SkyCoord(ra, dec, unit=(u.deg, u.deg), frame="icrs"), radius="0d0m2s"
-    )
+# pyplot isn't thread-safe, so without a render pool the stager and the
+# posting thread take turns drawing.
+_drawing_lock = threading.Lock()
+
+# catch_warnings swaps module-wide state, so only one thread may be inside it.
+_simbad_lock = threading.Lock()
+
 
+def simbad_query(function, *args, metrics=None, **kwargs):
+    """The table from a SIMBAD query, or None if it found nothing.
 
-def in_simbad(the_star, logger):
-    with warnings.catch_warnings():
-        warnings.filterwarnings("error")
+    Depending on its version, astroquery says nothing was found by returning
+    None or an empty table, with a warning, or by failing to parse the
+    result. The warnings are recorded and logged rather than made errors, as
+    the filters are shared by every thread."""
+    logger = logging.getLogger("robot_galah")
+    with _simbad_lock, warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter("always")
         try:
-            logger.info(f"Searching SIMBAD for Gaia DR2 {the_star['dr2_source_id']}")
-            result_table = Simbad.query_object(f"Gaia DR2 {the_star['dr2_source_id']}")
+            result_table = throttle.call(
+                "simbad", function, *args, metrics=metrics, **kwargs
+            )
         except TableParseError:
-            logger.info(f"No SIMBAD match for Gaia DR2 {the_star['dr2_source_id']}")
-            try:
-                logger.info(
-                    "Doing a sky search around %f, %f",
-                    the_star["ra_dr2"],
-                    the_star["dec_dr2"],
-                )
-                result_table = simbad_sky_search(
-                    the_star["ra_dr2"], the_star["dec_dr2"]
-                )
-            except TableParseError:
-                logger.info(
-                    f"No results for a sky search around {the_star['ra_dr2']:0.5f}, {the_star['dec_dr2']:0.5f}"
-                )
-                return None
-        logger.info(f"Found a match in SIMBAD: {result_table['MAIN_ID'][0]}")
-        return result_table["MAIN_ID"][0]
+            result_table = None
+    for warning in caught:
+        logger.debug("SIMBAD: %s", warning.message)
+    if result_table is None or len(result_table) == 0:
+        return None
+    return result_table
+
+
+def simbad_sky_search(ra, dec, metrics=None):
+    return simbad_query(
+        Simbad.query_region,
+        coord.SkyCoord(ra, dec, unit=(u.deg, u.deg), frame="icrs"),
+        radius="0d0m2s",
+        metrics=metrics,
+    )
+
+
+def in_simbad(the_star, logger, reference=None, local_only=False, metrics=None):
+    """The SIMBAD main id of the star, or None.
+
+    The local SIMBAD extract ``reference`` is checked first. Only if it has no
+    match (and not ``local_only``) is SIMBAD itself queried."""
+    if reference is not None:
+        simbad_main_id = reference.match(
+            the_star["dr2_source_id"], the_star["ra_dr2"], the_star["dec_dr2"]
+        )[0]
+        if metrics is not None:
+            metrics.cache_lookup("simbad_local", simbad_main_id is not None)
+        if simbad_main_id is not None:
+            logger.info(f"Found a match in the local SIMBAD extract: {simbad_main_id}")
+            return simbad_main_id
+        if local_only:
+            logger.info("No match in the local SIMBAD extract")
+            return None
+    logger.info(f"Searching SIMBAD for Gaia DR2 {the_star['dr2_source_id']}")
+    result_table = simbad_query(
+        Simbad.query_object, f"Gaia DR2 {the_star['dr2_source_id']}", metrics=metrics
+    )
+    if result_table is None:
+        logger.info(f"No SIMBAD match for Gaia DR2 {the_star['dr2_source_id']}")
+        logger.info(
+            "Doing a sky search around %f, %f",
+            the_star["ra_dr2"],
+            the_star["dec_dr2"],
+        )
+        result_table = simbad_sky_search(
+            the_star["ra_dr2"], the_star["dec_dr2"], metrics
+        )
+        if result_table is None:
+            logger.info(
+                f"No results for a sky search around {the_star['ra_dr2']:0.5f}, {the_star['dec_dr2']:0.5f}"
+            )
+            return None
+    logger.info(f"Found a match in SIMBAD: {result_table['MAIN_ID'][0]}")
+    return result_table["MAIN_ID"][0]
 
 
-def get_best_name(simbad_main_id, constellation_name, logger):
-    all_possible_names = Simbad.query_objectids(simbad_main_id)
+def get_best_name(simbad_main_id, constellation_name, logger, metrics=None):
+    all_possible_names = throttle.call(
+        "simbad", Simbad.query_objectids, simbad_main_id, metrics=metrics
+    )
     # Does this star have a common name?
     NAME_values = [
         " ".join(i[0].split()[1:])
@@ -312,28 +374,63 @@ def age_str(the_star):
 
 
 def get_star(
-    galah_dr3, logger=None, sobject_id_arg=None, dr3_source_id_arg=None, LOGGING=True
+    galah_dr3,
+    logger=None,
+    sobject_id_arg=None,
+    dr3_source_id_arg=None,
+    LOGGING=True,
+    eligible=None,
+    history=None,
+    sampler=None,
+    find=None,
 ):
+    """Returns the requested star, or a random one passing the basic cuts.
+
+    ``eligible`` are the row positions of the stars passing the cuts. With a
+    ``history`` the random star is one that hasn't been tweeted before. With a
+    ``sampler`` the star is drawn with its weights rather than uniformly.
+    ``find(column, value)``, if given, returns the rows of a requested star."""
+    if find is None:
+
+        def find(column, value):
+            return np.flatnonzero(galah_dr3[column].to_numpy() == value)
+
     if sobject_id_arg is not None:
         if LOGGING:
             logger.info("Told to do a specific star: sobject_id=%s", sobject_id_arg)
-        star_idx = galah_dr3["sobject_id"] == sobject_id_arg
-        if not np.any(star_idx):
+        star_rows = find("sobject_id", sobject_id_arg)
+        if len(star_rows) == 0:
             if LOGGING:
                 logger.error("Not a valid sobject_id. Quitting.")
             sys.exit("Not a valid sobject_id. Quitting.")
-        the_star = galah_dr3[star_idx]
+        the_star = galah_dr3.iloc[star_rows]
     elif dr3_source_id_arg is not None:
         if LOGGING:
             logger.info(
                 "Told to do a specific star: dr3_source_id=%s", dr3_source_id_arg
             )
-        star_idx = galah_dr3["dr3_source_id"] == dr3_source_id_arg
-        if not np.any(star_idx):
+        star_rows = find("dr3_source_id", dr3_source_id_arg)
+        if len(star_rows) == 0:
             if LOGGING:
                 logger.error("Not a valid dr3_source_id. Quitting.")
             sys.exit("Not a valid dr3_source_id. Quitting.")
-        the_star = galah_dr3[star_idx]
+        the_star = galah_dr3.iloc[star_rows]
+    elif eligible is not None:
+        if sampler is not None:
+            rand_idx = eligible[sampler.draw(history)]
+        elif history is not None:
+            rand_idx = eligible[history.draw()]
+        else:
+            rand_idx = eligible[np.random.randint(low=0, high=len(eligible))]
+        if LOGGING and history is not None:
+            logger.info(
+                "%i eligible stars left to tweet in epoch %i",
+                history.remaining,
+                history.epoch,
+            )
+        the_star = galah_dr3.iloc[[rand_idx]]
+        if LOGGING:
+            logger.info("Found a useful star: %s", the_star.iloc[0]["sobject_id"])
     else:
         USEFUL_STAR = False
         while USEFUL_STAR is False:
@@ -357,110 +454,119 @@ def get_star(
     return the_star.iloc[0]
 
 
-def main():
-    cwd = Path(__file__).parent
-    config_file = Path.joinpath(cwd, "logging.conf")
-    logging.config.fileConfig(config_file)
-    # create logger
-    logger = logging.getLogger("robot_galah")
-    logger.info("STARTING")
+BIRD_WORDS = [
+    "squawk",
+    "chirp",
+    "tweet",
+    "hoot",
+    "cacaw",
+    "quack",
+    "cluck",
+    "screech",
+    "coo",
+    "warble",
+    "honk",
+]
+
+survey_str = {
+    "galah_main": "during the main GALAH survey",
+    "galah_faint": "during the main GALAH survey",
+    "k2_hermes": "during the K2-HERMES survey",
+    "tess_hermes": "during the TESS-HERMES survey",
+    "other": "during a special programme",
+}
 
-    parser = argparse.ArgumentParser()
-    group = parser.add_mutually_exclusive_group()
-    group.add_argument("--sobject_id", help="Tweet a specific sobject_id.", type=int)
-    group.add_argument(
-        "--dr3_source_id", help="Tweet a specific dr3_source_id.", type=int
-    )
-    parser.add_argument(
-        "--dry_run", help="Do everything but tweet.", action="store_true"
-    )
-    args = parser.parse_args()
-    sobject_id_arg = args.sobject_id
-    DRY_RUN = args.dry_run
-    dr3_source_id_arg = args.dr3_source_id
 
-    tweet_content_dir = Path.joinpath(cwd, "tweet_content/.")
-    if tweet_content_dir.exists():
-        logger.debug(
-            "Deleting the old files in %s if they exist", tweet_content_dir.as_posix()
+def make_content(
+    catalogue,
+    secrets_dict,
+    logger,
+    metrics,
+    tweet_content_dir,
+    sobject_id_arg=None,
+    dr3_source_id_arg=None,
+    render_pool=None,
+    find_in_field=False,
+):
+    """Picks a star from the loaded catalogue and makes everything to tweet.
+
+    The images are written to tweet_content_dir and the rest is returned.
+    With a ``render_pool`` the images are drawn in its worker processes.
+    ``galah_in_field``, the other GALAH stars in the sky image, is only
+    worked out with ``find_in_field``, as it needs a KD-tree of the whole
+    catalogue; otherwise it is None."""
+    galah_dr3 = catalogue.galah_dr3
+    basest_idx_galah = catalogue.basest_idx_galah
+
+    with metrics.stage("get_star"):
+        the_star = get_star(
+            galah_dr3,
+            logger,
+            sobject_id_arg=sobject_id_arg,
+            dr3_source_id_arg=dr3_source_id_arg,
+            eligible=catalogue.eligible,
+            history=catalogue.history,
+            sampler=catalogue.sampler,
+            find=catalogue.find,
         )
-        for f in tweet_content_dir.iterdir():
-            if f.is_file:
-                logger.debug("Deleting %s", f.name)
-                f.unlink()
-    else:
-        logger.debug("Creating directory at %s", tweet_content_dir.as_posix())
-        tweet_content_dir.mkdir(parents=True, exist_ok=True)
-
-    secrets_dict = get_secrets(cwd, logger)
-    DATA_DIR = secrets_dict["DATA_DIR"]
-    DATA_FILE = secrets_dict[
-        "DATA_FILE"
-    ]  # "GALAH_DR3_main_allstar_ages_dynamics_bstep_v2.h5"
-
-    BIRD_WORDS = [
-        "squawk",
-        "chirp",
-        "tweet",
-        "hoot",
-        "cacaw",
-        "quack",
-        "cluck",
-        "screech",
-        "coo",
-        "warble",
-        "honk",
-    ]
-
-    galah_dr3 = pd.read_hdf(f"{DATA_DIR}/{DATA_FILE}")
-
-    basest_idx_galah = (
-        (galah_dr3["flag_sp"] == 0)
-        & (galah_dr3["flag_fe_h"] == 0)
-        & (galah_dr3["snr_c3_iraf"] > 30)
-    )
-
-    survey_str = {
-        "galah_main": "during the main GALAH survey",
-        "galah_faint": "during the main GALAH survey",
-        "k2_hermes": "during the K2-HERMES survey",
-        "tess_hermes": "during the TESS-HERMES survey",
-        "other": "during a special programme",
-    }
-
-    the_star = get_star(
-        galah_dr3,
-        logger,
-        sobject_id_arg=sobject_id_arg,
-        dr3_source_id_arg=dr3_source_id_arg,
-    )
-
-    d = datetime.strptime(str(the_star["sobject_id"])[:6], "%y%m%d").date()
-    obs_date_str = d.strftime("%-d %b %Y")
+    metrics.info["sobject_id"] = int(the_star["sobject_id"])
+    if (
+        sobject_id_arg is None
+        and dr3_source_id_arg is None
+        and catalogue.history is not None
+    ):
+        # Claimed in the history, so release_star can give it back on failure.
+        metrics.info["history_epoch"] = catalogue.history.epoch
+
+    # The text is worked out for every star when the catalogue is loaded
+    # (see text_fields.py), except for stars chosen by hand that aren't eligible.
+    obs_date_str = the_star["text_obs_date"]
+    if pd.isna(obs_date_str):
+        d = datetime.strptime(str(the_star["sobject_id"])[:6], "%y%m%d").date()
+        obs_date_str = d.strftime("%-d %b %Y")
     survey_name = the_star["survey_name"].strip()
 
     # There are about 300 otherwise good stars that lack BSTEP data
     if not np.isnan(the_star["age_bstep"]):
         HAS_BSTEP = True
-        distance = distance_str(the_star)
-        mass = mass_str(the_star)
-        age = age_str(the_star)
+        if not pd.isna(the_star["text_age"]):
+            distance = the_star["text_distance"]
+            mass = the_star["text_mass"]
+            age = the_star["text_age"]
+        else:
+            distance = distance_str(the_star)
+            mass = mass_str(the_star)
+            age = age_str(the_star)
     else:
         logger.warning("No BSTEP values for this star!")
         HAS_BSTEP = False
 
-    constellation_name = coord.get_constellation(
-        coord.SkyCoord(
-            the_star["ra_dr2"], the_star["dec_dr2"], unit=(u.deg, u.deg), frame="icrs"
+    with metrics.stage("constellation"):
+        constellation_name = coord.get_constellation(
+            coord.SkyCoord(
+                the_star["ra_dr2"],
+                the_star["dec_dr2"],
+                unit=(u.deg, u.deg),
+                frame="icrs",
+            )
         )
-    )
 
-    simbad_main_id = in_simbad(the_star, logger)
+    with metrics.stage("simbad"):
+        simbad_main_id = in_simbad(
+            the_star,
+            logger,
+            reference=catalogue.simbad,
+            local_only=secrets_dict.get("SIMBAD_LOCAL_ONLY", False),
+            metrics=metrics,
+        )
     cds_url = f"http://vizier.u-strasbg.fr/viz-bin/VizieR-6?-out.form=%2bH&-source=J/MNRAS/506/150&GALAH={the_star['sobject_id']}"
     if simbad_main_id is None:
         BEST_NAME = f"Gaia eDR3 {the_star['dr3_source_id']}"
     else:
-        BEST_NAME = get_best_name(simbad_main_id, constellation_name, logger)
+        with metrics.stage("simbad_best_name"):
+            BEST_NAME = get_best_name(
+                simbad_main_id, constellation_name, logger, metrics
+            )
         if BEST_NAME is None:
             logger.warning("No best name!")
             BEST_NAME = f"Gaia eDR3 {the_star['dr3_source_id']}"
@@ -478,12 +584,436 @@ def main():
     for l in tweet_list:
         logger.info(l)
 
-    plot_stellar_params(galah_dr3, the_star, BEST_NAME, basest_idx_galah)
-    hips_survey = get_hips_image(
-        the_star["ra_dr2"], the_star["dec_dr2"], BEST_NAME, secrets_dict
+    galah_in_field = None
+    if find_in_field:
+        with metrics.stage("galah_in_field"):
+            in_field = catalogue.in_field(the_star["ra_dr2"], the_star["dec_dr2"])
+            galah_in_field = [
+                int(i)
+                for i in galah_dr3["sobject_id"].to_numpy()[in_field]
+                if i != the_star["sobject_id"]
+            ]
+        logger.info("%i other GALAH stars are in the sky image", len(galah_in_field))
+
+    if render_pool is None:
+        # Only the drawing takes turns with other threads, not the downloads.
+        with metrics.stage("plot_stellar_params"), _drawing_lock:
+            plot_stellar_params(
+                galah_dr3, the_star, BEST_NAME, basest_idx_galah, tweet_content_dir
+            )
+        with metrics.stage("get_hips_image"):
+            base_image, hips_survey = fetch_hips_image(
+                the_star["ra_dr2"],
+                the_star["dec_dr2"],
+                tweet_content_dir,
+                metrics,
+                secrets_dict,
+            )
+            with metrics.stage("get_hips_image.overlay"), _drawing_lock:
+                add_overlay(
+                    base_image,
+                    secrets_dict,
+                    logging.getLogger("get_images"),
+                    tweet_content_dir,
+                    BEST_NAME,
+                    hips_survey,
+                )
+        with metrics.stage("plot_spectra"):
+            spectra = fetch_spectra(
+                the_star["sobject_id"],
+                metrics,
+                secrets_dict.get("SPECTRA_INDEX_FILE"),
+            )
+            with metrics.stage("plot_spectra.render"), _drawing_lock:
+                set_spectra_style()
+                render_spectra(
+                    spectra,
+                    the_star["rv_galah"],
+                    BEST_NAME,
+                    tweet_content_dir,
+                    logging.getLogger("plot_spectra"),
+                )
+    else:
+        # Draw each image in the pool as soon as what it needs is downloaded.
+        renders = render_pool.jobs()
+        try:
+            renders.stellar_params(
+                catalogue,
+                catalogue.find("sobject_id", the_star["sobject_id"])[0],
+                the_star,
+                BEST_NAME,
+                tweet_content_dir,
+            )
+            with metrics.stage("get_hips_image"):
+                base_image, hips_survey = fetch_hips_image(
+                    the_star["ra_dr2"],
+                    the_star["dec_dr2"],
+                    tweet_content_dir,
+                    metrics,
+                    secrets_dict,
+                )
+            renders.overlay(
+                base_image, secrets_dict, tweet_content_dir, BEST_NAME, hips_survey
+            )
+            with metrics.stage("plot_spectra"):
+                spectra = fetch_spectra(
+                    the_star["sobject_id"],
+                    metrics,
+                    secrets_dict.get("SPECTRA_INDEX_FILE"),
+                )
+            renders.spectra(spectra, the_star["rv_galah"], BEST_NAME, tweet_content_dir)
+        except BaseException:
+            renders.cancel()
+            raise
+        with metrics.stage("render_wait"):
+            renders.wait(metrics)
+    return {
+        "sobject_id": int(the_star["sobject_id"]),
+        "BEST_NAME": BEST_NAME,
+        "hips_survey": hips_survey,
+        "tweet_text": tweet_text,
+        "galah_in_field": galah_in_field,
+    }
+
+
+def release_star(catalogue, metrics, logger):
+    """Gives back the star this run drew from the history, as it wasn't tweeted."""
+    epoch = metrics.info.get("history_epoch")
+    if epoch is not None and catalogue.release(metrics.info["sobject_id"], epoch):
+        logger.info("Released %s for another run", metrics.info["sobject_id"])
+
+
+def post_star(
+    catalogue,
+    secrets_dict,
+    logger,
+    metrics,
+    tweet_content_dir,
+    sobject_id_arg=None,
+    dr3_source_id_arg=None,
+    DRY_RUN=False,
+    render_pool=None,
+    find_in_field=False,
+):
+    """Picks a star from the loaded catalogue, makes the content and tweets it."""
+    try:
+        content = make_content(
+            catalogue,
+            secrets_dict,
+            logger,
+            metrics,
+            tweet_content_dir,
+            sobject_id_arg=sobject_id_arg,
+            dr3_source_id_arg=dr3_source_id_arg,
+            render_pool=render_pool,
+            find_in_field=find_in_field,
+        )
+        with metrics.stage("tweet"):
+            tweet(
+                content["tweet_text"],
+                content["hips_survey"],
+                content["BEST_NAME"],
+                secrets_dict,
+                tweet_content_dir,
+                DRY_RUN,
+                metrics,
+            )
+    except BaseException:
+        release_star(catalogue, metrics, logger)
+        raise
+
+
+def staging_queue(cwd, secrets_dict):
+    queue_dir = secrets_dict.get("STAGING_DIR", Path.joinpath(cwd, "staged"))
+    return StagingQueue(queue_dir, secrets_dict.get("STAGING_BUDGET_MB", 500))
+
+
+def post_from_queue(queue, secrets_dict, logger, metrics, DRY_RUN=False):
+    """Tweets the oldest staged bundle. Returns False if the queue is empty."""
+    with metrics.stage("queue_pop"):
+        bundle = queue.pop()
+    if bundle is None:
+        return False
+    bundle_dir, manifest = bundle
+    metrics.info["sobject_id"] = manifest["sobject_id"]
+    metrics.info["bundle_id"] = manifest["bundle_id"]
+    try:
+        with metrics.stage("tweet"):
+            tweet(
+                manifest["tweet_text"],
+                manifest["hips_survey"],
+                manifest["BEST_NAME"],
+                secrets_dict,
+                bundle_dir,
+                DRY_RUN,
+                metrics,
+            )
+    except BaseException:
+        queue.release(bundle_dir)
+        raise
+    if DRY_RUN:
+        # Nothing was tweeted, so the bundle (and its star) is still to come.
+        queue.release(bundle_dir)
+    else:
+        queue.done(bundle_dir)
+    return True
+
+
+def main():
+    cwd = Path(__file__).parent
+    config_file = Path.joinpath(cwd, "logging.conf")
+    logging.config.fileConfig(config_file)
+    # create logger
+    logger = logging.getLogger("robot_galah")
+    logger.info("STARTING")
+
+    parser = argparse.ArgumentParser()
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("--sobject_id", help="Tweet a specific sobject_id.", type=int)
+    group.add_argument(
+        "--dr3_source_id", help="Tweet a specific dr3_source_id.", type=int
+    )
+    parser.add_argument(
+        "--dry_run", help="Do everything but tweet.", action="store_true"
+    )
+    parser.add_argument(
+        "--profile_stage",
+        help="Profile one stage, e.g. plot_spectra or get_hips_image.download.",
+    )
+    parser.add_argument(
+        "--profiler",
+        help="Profiler to use with --profile_stage.",
+        choices=PROFILERS,
+        default="cprofile",
+    )
+    parser.add_argument(
+        "--daemon",
+        help="Keep running and tweet a random star every --cadence minutes.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cadence",
+        help="Minutes between tweets in --daemon mode.",
+        type=float,
+        default=240.0,
+    )
+    parser.add_argument(
+        "--post_now",
+        help="In --daemon mode, tweet straight away rather than after one cadence.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--stratify",
+        help="Choose random stars by first choosing one of these groups.",
+        choices=STRATIFICATIONS,
+    )
+    parser.add_argument(
+        "--weights",
+        help=(
+            "Weights for the --stratify groups, e.g. k2_hermes=3,galah_main=1. "
+            "Groups not given have weight 1."
+        ),
+    )
+    parser.add_argument(
+        "--reset_history",
+        help="Forget which stars have been tweeted and start a new epoch.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--cleanup",
+        help=(
+            "When to delete the run's work directory in tweet_content. "
+            "Defaults to never for --dry_run and on_success otherwise."
+        ),
+        choices=CLEANUP_POLICIES,
+    )
+    parser.add_argument(
+        "--stage",
+        help=(
+            "Make bundles until this many are staged, then quit. "
+            "With --daemon, keep this many staged in the background and tweet from them."
+        ),
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--from_queue",
+        help="Tweet the oldest staged bundle (makes one if none are staged).",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--render_workers",
+        help="Draw the images in this many worker processes (0 draws them in turn).",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--galah_in_field",
+        help=(
+            "Find the other GALAH stars in the sky image "
+            "(always done for staged bundles)."
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--full_catalogue",
+        help="Keep every column of the catalogue at full precision.",
+        action="store_true",
+    )
+    args = parser.parse_args()
+    sobject_id_arg = args.sobject_id
+    DRY_RUN = args.dry_run
+    dr3_source_id_arg = args.dr3_source_id
+    try:
+        weights = parse_weights(args.weights, args.stratify)
+    except ValueError as e:
+        parser.error(str(e))
+
+    metrics_file = Path.joinpath(cwd, "robot_galah_metrics.jsonl")
+    catalogue_options = dict(
+        compact=not args.full_catalogue,
+        use_history=not DRY_RUN,
+        stratify=args.stratify,
+        weights=weights,
     )
-    plot_spectra(the_star["sobject_id"], the_star["rv_galah"], BEST_NAME)
-    tweet(tweet_text, hips_survey, BEST_NAME, secrets_dict, DRY_RUN)
+    tweet_content_base = Path.joinpath(cwd, "tweet_content")
+    sweep(tweet_content_base)
+    cleanup = args.cleanup
+    if cleanup is None:
+        cleanup = "never" if DRY_RUN else "on_success"
+
+    render_pool = None
+    if args.render_workers > 0:
+        render_pool = RenderPool(args.render_workers)
+        atexit.register(render_pool.close)
+
+    def load_catalogue(secrets_dict, **options):
+        try:
+            return Catalogue.from_secrets(secrets_dict, **options).load()
+        except UnknownStratumError as e:
+            # The strata of some stratifications are only known from the stars.
+            parser.error(f"--weights: {e}")
+
+    def new_metrics(**info):
+        metrics = RunMetrics(profile_stage=args.profile_stage, profiler=args.profiler)
+        metrics.info.update(info)
+        return metrics
+
+    def stage_bundle(queue, catalogue, secrets_dict):
+        with new_metrics(mode="stage").recording(metrics_file) as m:
+            bundle_dir = queue.reserve()
+            try:
+                content = make_content(
+                    catalogue,
+                    secrets_dict,
+                    logger,
+                    m,
+                    bundle_dir,
+                    render_pool=render_pool,
+                    find_in_field=True,
+                )
+            except BaseException:
+                queue.discard(bundle_dir)
+                release_star(catalogue, m, logger)
+                raise
+            with m.stage("queue_commit"):
+                bundle_dir = queue.commit(bundle_dir, content)
+            if bundle_dir is None:
+                release_star(catalogue, m, logger)
+            return bundle_dir
+
+    if args.daemon:
+        if sobject_id_arg is not None or dr3_source_id_arg is not None:
+            parser.error("--daemon only tweets random stars.")
+        queue = None
+        if args.stage > 0:
+            queue = staging_queue(cwd, get_secrets(cwd, logger))
+
+        def post(catalogue, secrets_dict, metrics):
+            if queue is not None and post_from_queue(
+                queue, secrets_dict, logger, metrics, DRY_RUN
+            ):
+                return
+            with work_dir(tweet_content_base, metrics.run_id, cleanup) as run_dir:
+                post_star(
+                    catalogue,
+                    secrets_dict,
+                    logger,
+                    metrics,
+                    run_dir,
+                    DRY_RUN=DRY_RUN,
+                    render_pool=render_pool,
+                    find_in_field=args.galah_in_field,
+                )
+
+        daemon = Daemon(
+            cwd,
+            lambda: get_secrets(cwd, logger),
+            post,
+            cadence_minutes=args.cadence,
+            post_now=args.post_now,
+            metrics_file=metrics_file,
+            profile_stage=args.profile_stage,
+            profiler=args.profiler,
+            queue=queue,
+            catalogue_options=catalogue_options,
+            reset_history=args.reset_history,
+        )
+        if queue is not None:
+            daemon.background.append(
+                Stager(
+                    queue,
+                    lambda: stage_bundle(queue, daemon.catalogue, daemon.secrets_dict),
+                    target=args.stage,
+                )
+            )
+        try:
+            daemon.run()
+        except UnknownStratumError as e:
+            parser.error(f"--weights: {e}")
+        return
+
+    secrets_dict = get_secrets(cwd, logger)
+
+    if args.stage > 0:
+        queue = staging_queue(cwd, secrets_dict)
+        catalogue = None
+        while len(queue) < args.stage:
+            if catalogue is None:
+                catalogue = load_catalogue(
+                    secrets_dict, **dict(catalogue_options, use_history=True)
+                )
+                if args.reset_history:
+                    catalogue.history.new_epoch()
+            if stage_bundle(queue, catalogue, secrets_dict) is None:
+                break
+        logger.info("%i bundles are staged", len(queue))
+        return
+
+    metrics = new_metrics()
+    with metrics.recording(metrics_file):
+        if args.from_queue and sobject_id_arg is None and dr3_source_id_arg is None:
+            queue = staging_queue(cwd, secrets_dict)
+            if post_from_queue(queue, secrets_dict, logger, metrics, DRY_RUN):
+                return
+            logger.warning("Nothing staged, making the tweet now")
+        with metrics.stage("catalogue_load"):
+            catalogue = load_catalogue(secrets_dict, **catalogue_options)
+        if args.reset_history and catalogue.history is not None:
+            catalogue.history.new_epoch()
+        with work_dir(tweet_content_base, metrics.run_id, cleanup) as run_dir:
+            post_star(
+                catalogue,
+                secrets_dict,
+                logger,
+                metrics,
+                run_dir,
+                sobject_id_arg=sobject_id_arg,
+                dr3_source_id_arg=dr3_source_id_arg,
+                DRY_RUN=DRY_RUN,
+                render_pool=render_pool,
+                find_in_field=args.galah_in_field,
+            )
 
 
 if __name__ == "__main__":
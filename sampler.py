@@ -0,0 +1,320 @@
+"""Weighted and stratified random choice of the star to tweet.
+
+The eligible stars are split into strata (e.g. by survey) and each stratum
+gets a weight. A stratum is chosen with a Walker/Vose alias table and then a
+star within it uniformly, so each draw is O(1) whatever the weights. The
+strata are saved next to the catalogue so they are only worked out once,
+and worked out again when the stars or the column they come from change."""
+
+import hashlib
+import json
+import logging
+from pathlib import Path
+
+import astropy.coordinates as coord
+import astropy.units as u
+import numpy as np
+
+STRATIFICATIONS = ["survey_name", "constellation", "bstep", "simbad_named"]
+# The catalogue columns each stratification is worked out from.
+STRATUM_COLUMNS = {
+    "survey_name": ["survey_name"],
+    "constellation": ["ra_dr2", "dec_dr2"],
+    "bstep": ["age_bstep"],
+    "simbad_named": ["simbad_main_id"],
+}
+# The strata of the stratifications that don't depend on the catalogue.
+FIXED_STRATA = {
+    "bstep": ["bstep", "no_bstep"],
+    "simbad_named": ["named", "unnamed"],
+}
+
+
+class UnknownStratumError(ValueError):
+    """Weights were given for a stratum with no stars in it."""
+
+
+class AliasTable:
+    """Vose's alias method for drawing ``i`` with probability ``weights[i]``."""
+
+    def __init__(self, weights=None, prob=None, alias=None):
+        if weights is not None:
+            prob, alias = self.build(weights)
+        self.prob = np.asarray(prob, dtype=float)
+        self.alias = np.asarray(alias, dtype=np.int64)
+
+    @staticmethod
+    def build(weights):
+        weights = np.asarray(weights, dtype=float)
+        if np.any(weights < 0) or weights.sum() <= 0:
+            raise ValueError("Weights must be non-negative and not all zero.")
+        n = len(weights)
+        scaled = weights * n / weights.sum()
+        prob = np.ones(n)
+        alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1]
+        large = [i for i in range(n) if scaled[i] >= 1]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            prob[s] = scaled[s]
+            alias[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1
+            if scaled[l] < 1:
+                small.append(l)
+            else:
+                large.append(l)
+        # Anything left is 1 up to rounding error.
+        for i in small + large:
+            prob[i] = 1.0
+        return prob, alias
+
+    def draw(self, rng):
+        i = rng.integers(len(self.prob))
+        if rng.random() < self.prob[i]:
+            return int(i)
+        return int(self.alias[i])
+
+
+def parse_weights(weights_arg, stratify=None):
+    """Turns ``"k2_hermes=3,galah_main=1"`` into a dictionary.
+
+    Raises ValueError if it isn't in that form, or (where the strata don't
+    depend on the catalogue) names a stratum ``stratify`` doesn't have."""
+    if not weights_arg:
+        return {}
+    if stratify is None:
+        raise ValueError("--weights needs --stratify.")
+    weights = {}
+    for item in weights_arg.split(","):
+        label, _, weight = item.partition("=")
+        try:
+            weight = float(weight)
+        except ValueError:
+            weight = None
+        if not label.strip() or weight is None or not 0 <= weight < np.inf:
+            raise ValueError(
+                f"Bad weight {item!r}: weights are like k2_hermes=3,galah_main=1 "
+                "with numbers of 0 or more."
+            )
+        weights[label.strip()] = weight
+    unknown = set(weights) - set(FIXED_STRATA.get(stratify, weights))
+    if unknown:
+        raise ValueError(
+            f"{stratify} has no strata {sorted(unknown)}, "
+            f"only {FIXED_STRATA[stratify]}."
+        )
+    return weights
+
+
+def _values_bytes(values):
+    values = np.asarray(values)
+    if values.dtype.kind == "O":
+        return "\0".join("" if v is None else str(v) for v in values).encode()
+    return np.ascontiguousarray(values).tobytes()
+
+
+def strata_fingerprint(galah_dr3, eligible, stratify, reference=None):
+    """A short hash of the eligible stars and the values their strata come from."""
+    digest = hashlib.blake2b(digest_size=8)
+    digest.update(np.ascontiguousarray(galah_dr3["sobject_id"].to_numpy()[eligible]))
+    for column in STRATUM_COLUMNS.get(stratify, []):
+        if column in galah_dr3:
+            digest.update(_values_bytes(galah_dr3[column].to_numpy()[eligible]))
+        elif stratify == "simbad_named" and reference is not None:
+            digest.update(_values_bytes(reference.main_id))
+            digest.update(reference.gaia_dr2_id.tobytes())
+    return digest.digest()
+
+
+def stratum_labels(galah_dr3, eligible, stratify, reference=None):
+    """The stratum of each eligible star, as an array of strings.
+
+    For simbad_named the catalogue's simbad_main_id column is used (see
+    ``spatial.py crossmatch``), or else the stars are matched to the local
+    SIMBAD extract ``reference``."""
+    if stratify == "survey_name":
+        return np.char.strip(galah_dr3["survey_name"].to_numpy()[eligible].astype(str))
+    if stratify == "bstep":
+        has_bstep = ~np.isnan(galah_dr3["age_bstep"].to_numpy()[eligible])
+        return np.where(has_bstep, *FIXED_STRATA["bstep"])
+    if stratify == "constellation":
+        return np.asarray(
+            coord.get_constellation(
+                coord.SkyCoord(
+                    galah_dr3["ra_dr2"].to_numpy()[eligible],
+                    galah_dr3["dec_dr2"].to_numpy()[eligible],
+                    unit=(u.deg, u.deg),
+                    frame="icrs",
+                ),
+                short_name=True,
+            )
+        )
+    if stratify == "simbad_named":
+        if "simbad_main_id" in galah_dr3:
+            named = galah_dr3["simbad_main_id"].fillna("").to_numpy()[eligible]
+        elif reference is not None:
+            named = reference.match(
+                galah_dr3["dr2_source_id"].to_numpy()[eligible],
+                galah_dr3["ra_dr2"].to_numpy()[eligible],
+                galah_dr3["dec_dr2"].to_numpy()[eligible],
+            )
+            named = np.where(named == None, "", named)  # noqa: E711
+        else:
+            raise ValueError(
+                "Stratifying by simbad_named needs a simbad_main_id column in the "
+                "catalogue (python spatial.py crossmatch ... --write) or a "
+                "SIMBAD_REFERENCE_FILE."
+            )
+        return np.where(
+            np.char.strip(named.astype(str)) != "", *FIXED_STRATA["simbad_named"]
+        )
+    raise ValueError(f"stratify must be one of {STRATIFICATIONS}")
+
+
+class StratifiedSampler:
+    """Draws positions in the eligible stars with per-stratum weights.
+
+    ``members`` holds the eligible positions grouped by stratum, with
+    ``starts[k]:starts[k + 1]`` the slice for stratum ``labels[k]``. Strata
+    not named in ``weights`` get weight 1, so no weights means every stratum
+    is equally likely however many stars it has."""
+
+    def __init__(self, labels, members, starts, weights=None):
+        self.labels = [str(label) for label in labels]
+        self.members = members
+        self.starts = starts
+        self.sizes = np.diff(starts)
+        self.rng = np.random.default_rng()
+        self.set_weights(weights or {})
+
+    @classmethod
+    def from_catalogue(
+        cls, galah_dr3, eligible, stratify, weights=None, reference=None
+    ):
+        star_labels = stratum_labels(galah_dr3, eligible, stratify, reference)
+        labels, codes = np.unique(star_labels, return_inverse=True)
+        members = np.argsort(codes, kind="stable")
+        starts = np.concatenate([[0], np.cumsum(np.bincount(codes))])
+        return cls(labels, members, starts, weights)
+
+    def set_weights(self, weights):
+        unknown = set(weights) - set(self.labels)
+        if unknown:
+            raise UnknownStratumError(
+                f"No stars in strata {sorted(unknown)}, only {list(self.labels)}"
+            )
+        self.weights = np.array([weights.get(label, 1.0) for label in self.labels])
+        self.table = AliasTable(self.weights)
+
+    def _pick(self, k):
+        return int(self.members[self.starts[k] + self.rng.integers(self.sizes[k])])
+
+    def draw(self, history=None, max_tries=32):
+        """A random eligible position; with a history, an untweeted one (claimed)."""
+        if history is None:
+            return self._pick(self.table.draw(self.rng))
+        for _ in range(max_tries):
+            i = self._pick(self.table.draw(self.rng))
+            if not history.posted(i) and history.claim(i):
+                return i
+        # Mostly tweeted already: only choose between what's left.
+        weights = self.weights.copy()
+        posted = history.posted_mask()
+        while True:
+            if not np.any(weights > 0):
+                logging.getLogger("sampler").info(
+                    "Every star with a non-zero weight has been tweeted"
+                )
+                history.new_epoch()
+                weights = self.weights.copy()
+                posted = history.posted_mask()
+            k = AliasTable(weights).draw(self.rng)
+            stratum = self.members[self.starts[k] : self.starts[k + 1]]
+            unposted = stratum[~posted[stratum]]
+            if len(unposted) == 0:
+                weights[k] = 0
+                continue
+            i = int(self.rng.choice(unposted))
+            if history.claim(i):
+                return i
+            # Claimed by another worker since we looked.
+            posted[i] = True
+
+    def save(self, path, catalogue_fingerprint, stratify):
+        np.savez(
+            path,
+            labels=np.asarray(self.labels),
+            members=self.members,
+            starts=self.starts,
+            prob=self.table.prob,
+            alias=self.table.alias,
+            meta=json.dumps(
+                {
+                    "fingerprint": catalogue_fingerprint.hex(),
+                    "stratify": stratify,
+                    "weights": dict(zip(self.labels, self.weights.tolist())),
+                }
+            ),
+        )
+
+    @classmethod
+    def load(cls, path, catalogue_fingerprint, stratify, weights=None):
+        """The saved sampler, or None if it was made for a different catalogue."""
+        with np.load(path) as saved:
+            meta = json.loads(str(saved["meta"]))
+            if (
+                meta["fingerprint"] != catalogue_fingerprint.hex()
+                or meta["stratify"] != stratify
+            ):
+                return None
+            sampler = cls.__new__(cls)
+            sampler.labels = saved["labels"].tolist()
+            sampler.members = saved["members"]
+            sampler.starts = saved["starts"]
+            sampler.sizes = np.diff(sampler.starts)
+            sampler.rng = np.random.default_rng()
+            weights = weights or {}
+            saved_weights = meta["weights"]
+            if all(
+                weights.get(label, 1.0) == saved_weights[label]
+                for label in sampler.labels
+            ):
+                sampler.weights = np.array(
+                    [saved_weights[label] for label in sampler.labels]
+                )
+                sampler.table = AliasTable(prob=saved["prob"], alias=saved["alias"])
+            else:
+                sampler.set_weights(weights)
+        return sampler
+
+
+def sampler_path(catalogue_file, stratify):
+    catalogue_file = Path(catalogue_file)
+    return catalogue_file.with_name(f"{catalogue_file.name}.sampler-{stratify}.npz")
+
+
+def load_sampler(
+    galah_dr3, eligible, catalogue_file, stratify, weights=None, reference=None
+):
+    """Loads the saved sampler for this stratification, or makes and saves it."""
+    logger = logging.getLogger("sampler")
+    path = sampler_path(catalogue_file, stratify)
+    catalogue_fingerprint = strata_fingerprint(galah_dr3, eligible, stratify, reference)
+    if path.exists():
+        sampler = StratifiedSampler.load(path, catalogue_fingerprint, stratify, weights)
+        if sampler is not None:
+            logger.info("Loaded the %s sampler from %s", stratify, path)
+            return sampler
+    logger.info("Working out the %s strata", stratify)
+    sampler = StratifiedSampler.from_catalogue(
+        galah_dr3, eligible, stratify, weights, reference
+    )
+    try:
+        sampler.save(path, catalogue_fingerprint, stratify)
+        logger.info("Saved the %s sampler to %s", stratify, path)
+    except OSError as e:
+        logger.warning("Could not save the sampler: %s", e)
+    for label, size, weight in zip(sampler.labels, sampler.sizes, sampler.weights):
+        logger.debug("Stratum %s: %i stars, weight %s", label, size, weight)
+    return sampler
@@ -0,0 +1,239 @@
+"""Cone searches against catalogues kept on disk, with no network access.
+
+Positions are stored as unit vectors in a KD-tree, so a cone search of radius
+r is a ball query of radius 2 sin(r / 2) (the chord length), and many
+positions can be searched at once. This is used for a local extract of
+SIMBAD, looked at before the remote SIMBAD queries, and for finding the other
+GALAH stars in the field of the sky image."""
+
+import argparse
+import logging
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+# Matches the radius of the remote SIMBAD sky search.
+SIMBAD_RADIUS_ARCSEC = 2.0
+# The width of the sky image, from get_images.download_image.
+FIELD_OF_VIEW_DEG = 0.25
+
+
+def unit_vectors(ra, dec):
+    """(N, 3) unit vectors for positions in degrees."""
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)])
+
+
+def chord(radius_deg):
+    return 2 * np.sin(np.radians(radius_deg) / 2)
+
+
+def tan_offsets(ra0, dec0, ra, dec):
+    """Gnomonic (TAN) projection of positions about (ra0, dec0), in degrees.
+
+    x increases to the east and y to the north, as on the sky image."""
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cos_c = np.sin(dec0) * np.sin(dec) + np.cos(dec0) * np.cos(dec) * np.cos(ra - ra0)
+    x = np.cos(dec) * np.sin(ra - ra0) / cos_c
+    y = (
+        np.cos(dec0) * np.sin(dec) - np.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)
+    ) / cos_c
+    return np.degrees(x), np.degrees(y)
+
+
+def tan_to_sky(ra0, dec0, x, y):
+    """The inverse of ``tan_offsets``: (ra, dec) in degrees of TAN offsets."""
+    ra0, dec0 = np.radians(ra0), np.radians(dec0)
+    x = np.radians(np.asarray(x, dtype=float))
+    y = np.radians(np.asarray(y, dtype=float))
+    d = np.cos(dec0) - y * np.sin(dec0)
+    ra = ra0 + np.arctan2(x, d)
+    dec = np.arctan2(np.sin(dec0) + y * np.cos(dec0), np.hypot(x, d))
+    return np.degrees(ra) % 360, np.degrees(dec)
+
+
+class SkyIndex:
+    """A KD-tree over positions in degrees. Results are positions in ``ra``."""
+
+    def __init__(self, ra, dec):
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        # Stars without positions can't be found, but keep their numbering.
+        self.positions = np.flatnonzero(np.isfinite(self.ra) & np.isfinite(self.dec))
+        self.tree = cKDTree(
+            unit_vectors(self.ra[self.positions], self.dec[self.positions])
+        )
+
+    def cone(self, ra, dec, radius_deg):
+        """Everything within ``radius_deg`` of (ra, dec), sorted.
+
+        With arrays of positions, a list with an array for each."""
+        points = unit_vectors(np.atleast_1d(ra), np.atleast_1d(dec))
+        matches = self.tree.query_ball_point(
+            points, chord(radius_deg), return_sorted=True
+        )
+        found = [self.positions[np.asarray(m, dtype=np.int64)] for m in matches]
+        return found[0] if np.ndim(ra) == 0 else found
+
+    def nearest(self, ra, dec, radius_deg):
+        """The closest thing within ``radius_deg`` of each position, or -1."""
+        points = unit_vectors(np.atleast_1d(ra), np.atleast_1d(dec))
+        distance, index = self.tree.query(
+            points, distance_upper_bound=chord(radius_deg)
+        )
+        found = np.isfinite(distance)
+        nearest = np.full(len(points), -1, dtype=np.int64)
+        nearest[found] = self.positions[index[found]]
+        return int(nearest[0]) if np.ndim(ra) == 0 else nearest
+
+    def in_field(self, ra, dec, fov_deg=FIELD_OF_VIEW_DEG):
+        """Everything inside a square TAN image ``fov_deg`` wide centred on (ra, dec)."""
+        # The circle through the corners of the image, then cut to the square.
+        candidates = self.cone(ra, dec, fov_deg / np.sqrt(2))
+        x, y = tan_offsets(ra, dec, self.ra[candidates], self.dec[candidates])
+        inside = (np.abs(x) <= fov_deg / 2) & (np.abs(y) <= fov_deg / 2)
+        return candidates[inside]
+
+
+def _gaia_dr2_ids(values):
+    """Gaia DR2 source ids as int64, from numbers or "Gaia DR2 ..." strings."""
+    values = np.asarray(values)
+    if values.dtype.kind in "iu":
+        return values.astype(np.int64)
+    ids = np.zeros(len(values), dtype=np.int64)
+    for i, value in enumerate(values):
+        value = value.decode() if isinstance(value, bytes) else str(value)
+        value = value.replace("Gaia DR2", "").strip()
+        if value.isdigit():
+            ids[i] = int(value)
+    return ids
+
+
+class SimbadReference:
+    """A local extract of SIMBAD: ``main_id`` at (ra, dec), and Gaia DR2 ids.
+
+    ``match`` answers the same questions as ``in_simbad``'s two remote
+    queries: the object with a star's Gaia DR2 id, or else the nearest object
+    within 2 arcseconds."""
+
+    def __init__(self, ra, dec, main_id, gaia_dr2_id=None):
+        self.ra = np.asarray(ra, dtype=float)
+        self.dec = np.asarray(dec, dtype=float)
+        self.main_id = np.asarray(main_id).astype(str)
+        if gaia_dr2_id is None:
+            gaia_dr2_id = np.zeros(len(self.ra), dtype=np.int64)
+        self.gaia_dr2_id = np.asarray(gaia_dr2_id, dtype=np.int64)
+        self.gaia_order = np.argsort(self.gaia_dr2_id, kind="stable")
+        self.index = SkyIndex(self.ra, self.dec)
+
+    def __len__(self):
+        return len(self.ra)
+
+    @classmethod
+    def load(cls, path):
+        """Loads an extract saved by ``save`` (see ``main`` to make one)."""
+        with np.load(path) as saved:
+            return cls(
+                saved["ra"], saved["dec"], saved["main_id"], saved["gaia_dr2_id"]
+            )
+
+    @classmethod
+    def from_table(cls, path):
+        """Reads any table astropy can (CSV, FITS, VOTable) with ra, dec, main_id
+        and optionally gaia_dr2_id columns."""
+        from astropy.table import Table
+
+        table = Table.read(path)
+        columns = {name.lower(): name for name in table.colnames}
+        gaia = columns.get("gaia_dr2_id")
+        return cls(
+            np.asarray(table[columns["ra"]], dtype=float),
+            np.asarray(table[columns["dec"]], dtype=float),
+            np.char.strip(np.asarray(table[columns["main_id"]]).astype(str)),
+            None if gaia is None else _gaia_dr2_ids(table[gaia]),
+        )
+
+    def save(self, path):
+        np.savez(
+            path,
+            ra=self.ra,
+            dec=self.dec,
+            main_id=self.main_id,
+            gaia_dr2_id=self.gaia_dr2_id,
+        )
+
+    def by_gaia_dr2_id(self, gaia_dr2_id):
+        """Positions of the objects with these Gaia DR2 ids, or -1."""
+        ids = np.atleast_1d(np.asarray(gaia_dr2_id, dtype=np.int64))
+        i = np.searchsorted(self.gaia_dr2_id, ids, sorter=self.gaia_order)
+        i = self.gaia_order[np.minimum(i, len(self.gaia_order) - 1)]
+        found = (self.gaia_dr2_id[i] == ids) & (ids != 0)
+        return np.where(found, i, -1)
+
+    def match(self, gaia_dr2_id, ra, dec, radius_arcsec=SIMBAD_RADIUS_ARCSEC):
+        """SIMBAD main ids for many stars at once, None where there's no match."""
+        gaia_dr2_id = np.atleast_1d(gaia_dr2_id)
+        ra, dec = np.atleast_1d(ra), np.atleast_1d(dec)
+        positions = self.by_gaia_dr2_id(np.nan_to_num(gaia_dr2_id).astype(np.int64))
+        missing = positions < 0
+        if np.any(missing):
+            positions[missing] = self.index.nearest(
+                ra[missing], dec[missing], radius_arcsec / 3600
+            )
+        main_ids = np.full(len(positions), None, dtype=object)
+        main_ids[positions >= 0] = self.main_id[positions[positions >= 0]]
+        return main_ids
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    convert = subparsers.add_parser(
+        "convert", help="Save a SIMBAD extract (CSV, FITS, VOTable) for in_simbad."
+    )
+    convert.add_argument("table_file", help="Table with ra, dec, main_id columns.")
+    convert.add_argument("out_file", help="The .npz file to write.")
+    crossmatch = subparsers.add_parser(
+        "crossmatch", help="Match a whole catalogue to a saved SIMBAD extract."
+    )
+    crossmatch.add_argument("reference_file", help="A file made by convert.")
+    crossmatch.add_argument("catalogue_file", help="The catalogue HDF5 file.")
+    crossmatch.add_argument(
+        "--write", help="Save the catalogue with a simbad_main_id column to this file."
+    )
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        reference = SimbadReference.from_table(args.table_file)
+        reference.save(args.out_file)
+        print(f"Saved {len(reference)} objects to {args.out_file}")
+        return
+
+    import pandas as pd
+
+    logger = logging.getLogger("spatial")
+    reference = SimbadReference.load(args.reference_file)
+    galah_dr3 = pd.read_hdf(args.catalogue_file)
+    logger.info("Matching %i stars to %i objects", len(galah_dr3), len(reference))
+    main_ids = reference.match(
+        galah_dr3["dr2_source_id"].to_numpy(),
+        galah_dr3["ra_dr2"].to_numpy(),
+        galah_dr3["dec_dr2"].to_numpy(),
+    )
+    print(
+        f"{np.sum(main_ids != None)} of {len(galah_dr3)} stars are in SIMBAD"
+    )  # noqa: E711
+    if args.write:
+        galah_dr3["simbad_main_id"] = pd.Series(
+            main_ids, index=galah_dr3.index, dtype=object
+        )
+        galah_dr3.to_hdf(args.write, key="galah_dr3")
+        print(f"Saved to {args.write}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,273 @@
+"""Where the spectra of each star are, looked up for many stars at once.
+
+``fetch_spectra`` needs the ``access_url`` of each of a star's four
+normalised spectra, which an SSA search gives one star at a time. This
+asks the Data Central TAP service for thousands of stars in a few queries
+(or, with ``--method ssa``, runs the SSA searches side by side) and keeps
+the answers in a SQLite file indexed on sobject_id, which ``fetch_spectra``
+reads before searching. Stars with no spectra are remembered too."""
+
+import argparse
+import io
+import logging
+import logging.config
+import sqlite3
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import requests
+from astropy.io.votable import parse
+
+import throttle
+
+TAP_URL = "https://datacentral.org.au/vo/tap"
+OBSCORE_TABLE = "ivoa.obscore"
+COLLECTION = "galah_dr3"
+# The middle of each HERMES band in metres, to tell the bands apart in ObsCore.
+BAND_CENTRES = {"B": 4.8e-7, "V": 5.76e-7, "R": 6.6e-7, "I": 7.75e-7}
+# Stars in each TAP query.
+BATCH_SIZE = 500
+
+
+def band_names(em_min, em_max):
+    """The HERMES band covering each wavelength range (metres)."""
+    middle = (np.asarray(em_min, dtype=float) + np.asarray(em_max, dtype=float)) / 2
+    names = np.array(list(BAND_CENTRES))
+    centres = np.array(list(BAND_CENTRES.values()))
+    return names[np.argmin(np.abs(middle[:, np.newaxis] - centres), axis=1)]
+
+
+class SpectraIndex:
+    """The ``access_url`` and ``band_name`` of each star's spectra, in SQLite."""
+
+    def __init__(self, path, read_only=False):
+        self.path = Path(path)
+        self.read_only = read_only
+        if read_only:
+            return
+        with closing(self._connect()) as db, db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS spectra (sobject_id INTEGER NOT NULL,"
+                " band_name TEXT NOT NULL, access_url TEXT NOT NULL,"
+                " PRIMARY KEY (sobject_id, band_name)) WITHOUT ROWID"
+            )
+            # Every star that has been looked up, including those with no spectra.
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS searched"
+                " (sobject_id INTEGER PRIMARY KEY, n_spectra INTEGER NOT NULL)"
+            )
+
+    def _connect(self):
+        if self.read_only:
+            return sqlite3.connect(
+                f"{self.path.resolve().as_uri()}?mode=ro", uri=True, timeout=60
+            )
+        db = sqlite3.connect(self.path, timeout=60)
+        db.execute("PRAGMA journal_mode=WAL")
+        return db
+
+    def __len__(self):
+        with closing(self._connect()) as db:
+            return db.execute("SELECT COUNT(*) FROM searched").fetchone()[0]
+
+    def lookup(self, sobject_id):
+        """A DataFrame of band_name and access_url, or None if it was never searched."""
+        with closing(self._connect()) as db:
+            searched = db.execute(
+                "SELECT n_spectra FROM searched WHERE sobject_id = ?",
+                (int(sobject_id),),
+            ).fetchone()
+            if searched is None:
+                return None
+            rows = db.execute(
+                "SELECT band_name, access_url FROM spectra WHERE sobject_id = ?"
+                " ORDER BY band_name",
+                (int(sobject_id),),
+            ).fetchall()
+        return pd.DataFrame(rows, columns=["band_name", "access_url"])
+
+    def missing(self, sobject_ids):
+        """The ones of ``sobject_ids`` that haven't been searched."""
+        sobject_ids = np.unique(np.asarray(sobject_ids, dtype=np.int64))
+        with closing(self._connect()) as db:
+            done = np.fromiter(
+                (row[0] for row in db.execute("SELECT sobject_id FROM searched")),
+                dtype=np.int64,
+            )
+        return sobject_ids[~np.isin(sobject_ids, done)]
+
+    def add(self, sobject_ids, found):
+        """Saves ``found`` (sobject_id, band_name, access_url) for ``sobject_ids``."""
+        found = found[found["sobject_id"].isin(sobject_ids)]
+        counts = found["sobject_id"].value_counts()
+        with closing(self._connect()) as db, db:
+            db.executemany(
+                "INSERT OR REPLACE INTO spectra VALUES (?, ?, ?)",
+                (
+                    (int(sobject_id), str(band_name), str(access_url))
+                    for sobject_id, band_name, access_url in found[
+                        ["sobject_id", "band_name", "access_url"]
+                    ].itertuples(index=False)
+                ),
+            )
+            db.executemany(
+                "INSERT OR REPLACE INTO searched VALUES (?, ?)",
+                (
+                    (int(sobject_id), int(counts.get(sobject_id, 0)))
+                    for sobject_id in sobject_ids
+                ),
+            )
+
+
+def tap_query(sobject_ids, tap_url=TAP_URL, table=OBSCORE_TABLE, metrics=None):
+    """The normalised spectra of ``sobject_ids`` from one ObsCore query.
+
+    Raises ValueError if the query failed or its results were cut short, so
+    the stars aren't saved as having fewer spectra than they do."""
+    maxrec = 10 * len(sobject_ids)
+    targets = ", ".join(f"'{int(sobject_id)}'" for sobject_id in sobject_ids)
+    query = (
+        f"SELECT target_name, access_url, em_min, em_max FROM {table}"
+        f" WHERE obs_collection = '{COLLECTION}'"
+        " AND dataproduct_subtype = 'normalised'"
+        f" AND target_name IN ({targets})"
+    )
+    response = throttle.call(
+        "datacentral",
+        throttle.session().post,
+        f"{tap_url}/sync",
+        data={
+            "REQUEST": "doQuery",
+            "LANG": "ADQL",
+            "FORMAT": "votable",
+            "MAXREC": maxrec,
+            "QUERY": query,
+        },
+        metrics=metrics,
+    )
+    response.raise_for_status()
+    if metrics is not None:
+        metrics.add_bytes("datacentral_tap", len(response.content))
+    try:
+        votable = parse(io.BytesIO(response.content))
+    except ValueError:
+        raise ValueError(f"The TAP query failed: {response.text[:500]}")
+    status = {
+        info.value: info.content
+        for info in votable.infos
+        + [info for resource in votable.resources for info in resource.infos]
+        if info.name == "QUERY_STATUS"
+    }
+    if "ERROR" in status:
+        raise ValueError(f"The TAP query failed: {status['ERROR']}")
+    tables = list(votable.iter_tables())
+    if not tables:
+        raise ValueError(f"The TAP query gave no table: {response.text[:500]}")
+    table = tables[0].to_table(use_names_over_ids=True)
+    if "OVERFLOW" in status or len(table) >= maxrec:
+        raise ValueError(
+            f"The TAP query stopped at {len(table)} rows, try a smaller --batch_size"
+        )
+    return pd.DataFrame(
+        {
+            "sobject_id": np.asarray(table["target_name"]).astype(str).astype(np.int64),
+            "band_name": band_names(table["em_min"], table["em_max"]),
+            "access_url": np.asarray(table["access_url"]).astype(str),
+        }
+    )
+
+
+def ssa_query(sobject_id, metrics=None):
+    """The normalised spectra of one star from an SSA search."""
+    from plot_spectra import search_spectra
+
+    found = search_spectra(sobject_id, metrics)
+    return pd.DataFrame(
+        {
+            "sobject_id": int(sobject_id),
+            "band_name": found["band_name"].astype(str),
+            "access_url": found["access_url"].astype(str),
+        }
+    )
+
+
+def resolve(
+    index, sobject_ids, method="tap", batch_size=BATCH_SIZE, workers=4, tap_url=TAP_URL
+):
+    """Looks up the stars in ``sobject_ids`` that aren't in ``index`` yet."""
+    logger = logging.getLogger("spectra_index")
+    todo = index.missing(sobject_ids)
+    logger.info("Looking up the spectra of %i stars by %s", len(todo), method)
+    batches = [
+        todo[start : start + batch_size] for start in range(0, len(todo), batch_size)
+    ]
+
+    def run(batch):
+        if method == "tap":
+            return batch, tap_query(batch, tap_url)
+        # The throttle keeps the searches to what Data Central allows.
+        return batch, pd.concat(
+            [ssa_query(sobject_id) for sobject_id in batch], ignore_index=True
+        )
+
+    with ThreadPoolExecutor(workers) as executor:
+        for done, (batch, found) in enumerate(executor.map(run, batches), 1):
+            index.add(batch, found)
+            logger.info(
+                "Batch %i of %i: %i spectra for %i stars",
+                done,
+                len(batches),
+                len(found),
+                len(batch),
+            )
+    return len(todo)
+
+
+def main():
+    logging.config.fileConfig(Path.joinpath(Path(__file__).parent, "logging.conf"))
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("index_file", help="The SQLite file to add to.")
+    parser.add_argument("catalogue_file", help="The catalogue HDF5 file.")
+    parser.add_argument(
+        "--all",
+        help="Every star, not just the ones that can be tweeted.",
+        action="store_true",
+    )
+    parser.add_argument("--method", choices=["tap", "ssa"], default="tap")
+    parser.add_argument(
+        "--batch_size",
+        help="Stars in each TAP query (or each group of SSA searches).",
+        type=int,
+        default=BATCH_SIZE,
+    )
+    parser.add_argument("--workers", help="Queries at once.", type=int, default=4)
+    parser.add_argument("--tap_url", help="The TAP service to ask.", default=TAP_URL)
+    args = parser.parse_args()
+
+    from catalogue import basic_cuts
+
+    galah_dr3 = pd.read_hdf(args.catalogue_file)
+    if not args.all:
+        galah_dr3 = galah_dr3[basic_cuts(galah_dr3)]
+    index = SpectraIndex(args.index_file)
+    try:
+        n = resolve(
+            index,
+            galah_dr3["sobject_id"].to_numpy(),
+            args.method,
+            args.batch_size,
+            args.workers,
+            args.tap_url,
+        )
+    except (requests.RequestException, ValueError) as e:
+        sys.exit(f"Could not look up the spectra: {e}")
+    print(f"Looked up {n} stars, {len(index)} in {args.index_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""A queue of ready-to-tweet bundles made ahead of time.
+
+Each bundle is a directory holding the four images and a ``manifest.json``
+with the tweet text and alt text. Bundles are built in a temporary directory
+and renamed into place, so a reader never sees a half-written bundle, and
+claimed with another rename, so two posters never tweet the same one."""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from pathlib import Path
+
+from do_the_tweeting import alt_texts
+
+MANIFEST = "manifest.json"
+
+
+def _dir_bytes(path):
+    return sum(f.stat().st_size for f in Path(path).iterdir() if f.is_file())
+
+
+def _sha256(filename):
+    with open(filename, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class StagingQueue:
+    """Ready bundles live in ``queue_dir/<bundle_id>``, oldest first.
+
+    Nothing is added once the bundles take up more than ``budget_mb``."""
+
+    def __init__(self, queue_dir, budget_mb=500):
+        self.queue_dir = Path(queue_dir)
+        self.budget_bytes = budget_mb * 1024**2
+        self.logger = logging.getLogger("staging")
+        self.queue_dir.mkdir(parents=True, exist_ok=True)
+        self._remove_leftovers()
+
+    def _remove_leftovers(self, max_age_hours=24):
+        """Removes temporary and claimed bundles abandoned by a crashed run."""
+        for path in self.queue_dir.glob(".*-*"):
+            if time.time() - path.stat().st_mtime > max_age_hours * 3600:
+                self.logger.warning("Removing abandoned %s", path)
+                shutil.rmtree(path, ignore_errors=True)
+
+    def ready(self):
+        return sorted(
+            path
+            for path in self.queue_dir.iterdir()
+            if path.is_dir() and not path.name.startswith(".")
+        )
+
+    def __len__(self):
+        return len(self.ready())
+
+    def usage_bytes(self):
+        return sum(
+            _dir_bytes(path) for path in self.queue_dir.iterdir() if path.is_dir()
+        )
+
+    def has_room(self):
+        return self.usage_bytes() < self.budget_bytes
+
+    def reserve(self):
+        """A new temporary directory to make the next bundle in."""
+        tmp_dir = Path.joinpath(self.queue_dir, f".tmp-{uuid.uuid4().hex}")
+        tmp_dir.mkdir()
+        return tmp_dir
+
+    def discard(self, tmp_dir):
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def commit(self, tmp_dir, content):
+        """Adds the images made in ``tmp_dir`` to the queue as a bundle.
+
+        ``content`` is the dictionary returned by ``make_content``. Returns
+        the bundle directory, or None if the bundle would go over budget."""
+        tmp_dir = Path(tmp_dir)
+        alt_text_dict = alt_texts(content["hips_survey"], content["BEST_NAME"])
+        files = [Path.joinpath(tmp_dir, name) for name in alt_text_dict]
+        # Anything else (e.g. the sky image before the overlay) isn't tweeted.
+        for f in tmp_dir.iterdir():
+            if f not in files:
+                f.unlink()
+        if self.usage_bytes() > self.budget_bytes:
+            self.logger.warning(
+                "Staging queue is over its %i MB budget, not adding %s",
+                self.budget_bytes // 1024**2,
+                content["sobject_id"],
+            )
+            self.discard(tmp_dir)
+            return None
+
+        created = datetime.now(timezone.utc)
+        bundle_id = f"{created.strftime('%Y%m%dT%H%M%S%f')}_{content['sobject_id']}"
+        manifest = dict(
+            content,
+            bundle_id=bundle_id,
+            created=created.isoformat(),
+            alt_text=alt_text_dict,
+            files={
+                f.name: {"bytes": f.stat().st_size, "sha256": _sha256(f)} for f in files
+            },
+        )
+        Path.joinpath(tmp_dir, MANIFEST).write_text(
+            json.dumps(manifest, indent=2), encoding="utf-8"
+        )
+        bundle_dir = Path.joinpath(self.queue_dir, bundle_id)
+        os.rename(tmp_dir, bundle_dir)
+        self.logger.info("Staged %s", bundle_dir)
+        return bundle_dir
+
+    def pop(self):
+        """Claims the oldest good bundle. Returns (bundle_dir, manifest) or None."""
+        for path in self.ready():
+            claimed = Path.joinpath(self.queue_dir, f".claimed-{path.name}")
+            try:
+                os.rename(path, claimed)
+            except FileNotFoundError:
+                # Someone else claimed it first.
+                continue
+            # Renaming doesn't change the mtime, which _remove_leftovers goes
+            # by, and a bundle can wait in the queue for longer than a day.
+            os.utime(claimed)
+            try:
+                manifest = json.loads(
+                    Path.joinpath(claimed, MANIFEST).read_text(encoding="utf-8")
+                )
+                for name, info in manifest["files"].items():
+                    if Path.joinpath(claimed, name).stat().st_size != info["bytes"]:
+                        raise ValueError(f"{name} is the wrong size")
+            except (OSError, ValueError, KeyError) as e:
+                self.logger.error("Bad bundle %s: %s", path.name, e)
+                shutil.rmtree(claimed, ignore_errors=True)
+                continue
+            self.logger.info("Claimed %s", path.name)
+            return claimed, manifest
+        self.logger.info("No staged bundles ready")
+        return None
+
+    def release(self, claimed):
+        """Puts a claimed bundle back, e.g. if the tweet failed."""
+        claimed = Path(claimed)
+        bundle_id = claimed.name[len(".claimed-") :]
+        os.rename(claimed, Path.joinpath(self.queue_dir, bundle_id))
+
+    def done(self, claimed):
+        shutil.rmtree(claimed)
+
+
+class Stager(threading.Thread):
+    """Keeps ``target`` bundles in the queue by calling ``make_bundle``.
+
+    ``make_bundle()`` should make one bundle and commit it to the queue. If it
+    fails (the pipeline quits with sys.exit when a service is down) we wait
+    ``retry_seconds`` and try again."""
+
+    def __init__(self, queue, make_bundle, target, poll_seconds=30, retry_seconds=300):
+        super().__init__(name="stager", daemon=True)
+        self.queue = queue
+        self.make_bundle = make_bundle
+        self.target = target
+        self.poll_seconds = poll_seconds
+        self.retry_seconds = retry_seconds
+        self.logger = logging.getLogger("staging")
+        self._stop_event = threading.Event()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            if len(self.queue) >= self.target or not self.queue.has_room():
+                self._stop_event.wait(self.poll_seconds)
+                continue
+            try:
+                self.make_bundle()
+            except SystemExit as e:
+                self.logger.error("Staging a bundle failed: %s", e.code)
+                self._stop_event.wait(self.retry_seconds)
+            except Exception:
+                self.logger.exception("Staging a bundle failed")
+                self._stop_event.wait(self.retry_seconds)
@@ -0,0 +1,147 @@
+import numpy as np
+import pandas as pd
+import pytest
+from astropy.table import Table
+
+import build_catalogue
+from catalogue import basic_cuts, load_index
+from text_fields import add_text_columns
+
+N_ROWS = 2500
+CHUNK_ROWS = 400
+
+
+@pytest.fixture(scope="module")
+def tables(tmp_path_factory):
+    """Small allstar, ages and dynamics FITS tables, and what joining them gives."""
+    root = tmp_path_factory.mktemp("fits")
+    rng = np.random.default_rng(3)
+    sobject_ids = np.sort(
+        rng.choice([131216, 140101, 170101], N_ROWS).astype(np.int64) * 10**9
+        + rng.integers(0, 10**9, N_ROWS)
+    )
+    allstar = pd.DataFrame(
+        {
+            "sobject_id": sobject_ids,
+            "dr3_source_id": rng.integers(0, 2**62, N_ROWS),
+            "ra": rng.uniform(0, 360, N_ROWS),
+            "dec": rng.uniform(-80, 0, N_ROWS),
+            "ra_dr2": rng.uniform(0, 360, N_ROWS),
+            "dec_dr2": rng.uniform(-80, 0, N_ROWS),
+            "teff": rng.normal(5500, 500, N_ROWS),
+            "logg": rng.normal(4, 1, N_ROWS),
+            "fe_h": rng.normal(0, 0.3, N_ROWS),
+            "alpha_fe": rng.normal(0, 0.1, N_ROWS),
+            "rv_galah": rng.normal(0, 30, N_ROWS),
+            "snr_c3_iraf": rng.uniform(10, 100, N_ROWS),
+            "flag_sp": rng.choice([0, 0, 1], N_ROWS).astype(np.int32),
+            "flag_fe_h": rng.choice([0, 0, 0, 4], N_ROWS).astype(np.int16),
+            "flag_alpha_fe": rng.choice([0, 1], N_ROWS).astype(np.int16),
+            "survey_name": rng.choice(["galah_main  ", "k2_hermes   "], N_ROWS),
+            "unused": rng.normal(size=N_ROWS),
+        }
+    )
+    # Not every star has an age, and the side tables are in another order.
+    with_age = rng.permutation(N_ROWS)[: N_ROWS - 100]
+    ages = pd.DataFrame(
+        {
+            "sobject_id": sobject_ids[with_age],
+            "age_bstep": rng.uniform(0.1, 13, len(with_age)),
+            "distance_bstep": rng.uniform(0.01, 5, len(with_age)),
+            "e_distance_bstep": rng.uniform(0.001, 0.5, len(with_age)),
+            "m_act_bstep": rng.uniform(0.5, 3, len(with_age)),
+            # Also in the allstar table, which it should be taken from.
+            "teff": np.zeros(len(with_age)),
+        }
+    )
+    shuffled = rng.permutation(N_ROWS)
+    dynamics = pd.DataFrame(
+        {
+            "sobject_id": sobject_ids[shuffled],
+            **{
+                column: rng.normal(size=N_ROWS)
+                for column in ["L_Z", "Energy", "U_UVW", "V_UVW", "W_UVW"]
+            },
+        }
+    )
+    paths = {}
+    for name, table in [
+        ("allstar", allstar),
+        ("ages", ages),
+        ("dynamics", dynamics),
+    ]:
+        paths[name] = root / f"{name}.fits"
+        Table.from_pandas(table).write(paths[name])
+
+    expected = allstar.merge(
+        ages.drop(columns="teff"), on="sobject_id", how="left"
+    ).merge(dynamics, on="sobject_id", how="left")
+    expected["survey_name"] = expected["survey_name"].str.strip()
+    expected["U_UVW_W_UVW"] = np.hypot(expected["U_UVW"], expected["W_UVW"])
+    add_text_columns(expected, np.flatnonzero(basic_cuts(expected).to_numpy()))
+    return paths, expected
+
+
+def build(paths, out_file):
+    return build_catalogue.build(
+        paths["allstar"], paths["ages"], paths["dynamics"], out_file, CHUNK_ROWS
+    )
+
+
+def test_build_matches_merge(tables, tmp_path):
+    paths, expected = tables
+    built = pd.read_hdf(build(paths, tmp_path / "galah.h5"))
+    assert "unused" not in built
+    assert built["U_UVW_W_UVW"].dtype == np.float32
+    assert len(built) == len(expected)
+    for column in built.columns:
+        values, merged = built[column], expected[column]
+        if values.dtype.kind == "f":
+            np.testing.assert_allclose(
+                values, merged.astype(values.dtype), equal_nan=True, err_msg=column
+            )
+        else:
+            assert (
+                values.fillna("").to_numpy() == merged.fillna("").to_numpy()
+            ).all(), column
+
+
+def test_interrupted_build_carries_on(tables, tmp_path, monkeypatch):
+    paths, _ = tables
+    whole = pd.read_hdf(build(paths, tmp_path / "whole.h5"))
+
+    make_chunk = build_catalogue._make_chunk
+    made = []
+
+    def counted(allstar, plan, start, stop):
+        made.append(start)
+        if len(made) == interrupt_at:
+            raise KeyboardInterrupt
+        return make_chunk(allstar, plan, start, stop)
+
+    monkeypatch.setattr(build_catalogue, "_make_chunk", counted)
+    out_file = tmp_path / "resumed.h5"
+    interrupt_at = 3
+    with pytest.raises(KeyboardInterrupt):
+        build(paths, out_file)
+    assert not out_file.exists()
+
+    made.clear()
+    interrupt_at = None
+    build(paths, out_file)
+    # Only the chunks that weren't written are made again.
+    assert made[0] == 2 * CHUNK_ROWS
+    pd.testing.assert_frame_equal(pd.read_hdf(out_file), whole)
+
+
+def test_index_eligible_is_basic_cuts(tables, tmp_path):
+    paths, _ = tables
+    out_file = build(paths, tmp_path / "galah.h5")
+    built = pd.read_hdf(out_file)
+    index = load_index(out_file, len(built))
+    assert index is not None
+    np.testing.assert_array_equal(
+        index["eligible"], np.flatnonzero(basic_cuts(built).to_numpy())
+    )
+    sobject_ids = built["sobject_id"].to_numpy()
+    assert (np.diff(sobject_ids[index["order_sobject_id"]]) >= 0).all()
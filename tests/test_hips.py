@@ -0,0 +1,207 @@
+import io
+import json
+import re
+from pathlib import Path
+
+import astropy.units as u
+import numpy as np
+import pytest
+from astropy.coordinates import SkyCoord
+from astropy_healpix import healpix_to_lonlat, lonlat_to_healpix
+from PIL import Image
+
+import throttle
+from hips import CutoutEngine, TileStore, compare, tile_pixels
+
+SURVEY_URL = "http://hips.test/synthetic"
+TILE_ORDER = 3
+MAX_ORDER = 5
+TILE_BITS = 3
+# Where each child of a tile is in a JPEG or PNG tile, as (row, column)
+# halves, from HipsTile.children in the hips package: the tiles are stored
+# upside down from their FITS orientation, where child 0 is the bottom left.
+CHILD_QUADRANTS = {0: (0, 0), 1: (1, 0), 2: (0, 1), 3: (1, 1)}
+# A recording made by ``python hips.py ... --record`` (see the README).
+FIXTURE = Path(__file__).parent / "data" / "hips" / "fixture.json"
+# How different a cutout can be from hips2fits, in 0-255 levels. hips2fits
+# interpolates and its images are JPEGs, so they aren't the same pixel for pixel.
+MEAN_TOLERANCE = 8
+P99_TOLERANCE = 96
+
+
+def layout(npix, bits):
+    """The HEALPix pixel at each (row, column) of tile ``npix``."""
+    if bits == 0:
+        return np.array([[npix]], dtype=np.int64)
+    w = 2 ** (bits - 1)
+    pixels = np.empty((2 * w, 2 * w), dtype=np.int64)
+    for child, (row, column) in CHILD_QUADRANTS.items():
+        pixels[row * w : (row + 1) * w, column * w : (column + 1) * w] = layout(
+            4 * npix + child, bits - 1
+        )
+    return pixels
+
+
+def encode(ipix):
+    return np.stack([ipix % 256, ipix // 256 % 256, ipix // 65536], axis=-1).astype(
+        np.uint8
+    )
+
+
+def decode(rgb):
+    rgb = np.asarray(rgb, dtype=np.int64)
+    return rgb[..., 0] + 256 * rgb[..., 1] + 65536 * rgb[..., 2]
+
+
+class Response:
+    def __init__(self, content, status_code=200):
+        self.content = content
+        self.text = content.decode("latin1")
+        self.status_code = status_code
+        self.headers = {}
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise AssertionError(f"HTTP {self.status_code}")
+
+
+class SyntheticHips:
+    """A HiPS server whose tile pixels are coloured by their HEALPix index."""
+
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, timeout=None):
+        self.requests.append(url)
+        if url == f"{SURVEY_URL}/properties":
+            return Response(
+                f"ID = test/synthetic\nhips_order = {MAX_ORDER}\n"
+                f"hips_tile_width = {2**TILE_BITS}\nhips_tile_format = png\n"
+                "hips_frame = equatorial\n".encode()
+            )
+        npix = int(re.search(r"Npix(\d+)\.png$", url).group(1))
+        data = io.BytesIO()
+        Image.fromarray(encode(layout(npix, TILE_BITS))).save(data, format="png")
+        return Response(data.getvalue())
+
+
+@pytest.fixture
+def no_waiting(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        throttle,
+        "_throttle",
+        throttle.Throttle(
+            tmp_path / "throttle",
+            {"hips_tiles": {"rate": 1000, "burst": 1000, "max_in_flight": 8}},
+        ),
+    )
+
+
+@pytest.fixture
+def server(monkeypatch, no_waiting):
+    server = SyntheticHips()
+    monkeypatch.setattr(throttle, "session", lambda: server)
+    return server
+
+
+def test_tile_pixels_match_the_hips_layout():
+    rng = np.random.default_rng(5)
+    for npix in rng.choice(12 * 4**TILE_ORDER, 20, replace=False):
+        expected = layout(npix, TILE_BITS)
+        order = TILE_ORDER + TILE_BITS
+        lon, lat = healpix_to_lonlat(expected.ravel(), 2**order, order="nested")
+        tile, row, column = tile_pixels(
+            lon.to_value(u.deg), lat.to_value(u.deg), TILE_ORDER, TILE_BITS
+        )
+        assert (tile == npix).all()
+        assert (expected[row, column] == expected.ravel()).all()
+
+
+def test_cutout_takes_pixels_from_the_right_place(server, tmp_path):
+    order = MAX_ORDER + TILE_BITS
+    pixel_deg = np.degrees(np.sqrt(np.pi / 3) / 2**order)
+    size = 21
+    engine = CutoutEngine(
+        TileStore(tmp_path / "tiles"), size=size, fov_deg=size * pixel_deg
+    )
+    rng = np.random.default_rng(6)
+    for ra, dec in zip(rng.uniform(0, 360, 10), rng.uniform(-80, 80, 10)):
+        image = engine.cutout(SURVEY_URL, ra, dec)
+        assert decode(image[size // 2, size // 2]) == lonlat_to_healpix(
+            ra * u.deg, dec * u.deg, 2**order, order="nested"
+        )
+        # North up and east left: the top left is north-east of the star.
+        offset = (size - 1) / 2 * engine.pixel_deg * u.deg
+        star = SkyCoord(ra * u.deg, dec * u.deg)
+        for (row, column), (east, north) in {
+            (0, 0): (1, 1),
+            (0, size - 1): (-1, 1),
+            (size - 1, 0): (1, -1),
+            (size - 1, size - 1): (-1, -1),
+        }.items():
+            lon, lat = healpix_to_lonlat(
+                decode(image[row, column]), 2**order, order="nested"
+            )
+            corner = star.spherical_offsets_by(east * offset, north * offset)
+            assert corner.separation(SkyCoord(lon, lat)) < 1.5 * pixel_deg * u.deg
+
+
+def test_tiles_are_downloaded_once(server, tmp_path):
+    store = TileStore(tmp_path / "tiles")
+    engine = CutoutEngine(store, size=50, fov_deg=5)
+    first = engine.cutout(SURVEY_URL, 10, -30)
+    downloads = len(server.requests)
+    assert store.stats["misses"] > 0
+    # A new store over the same directory uses the tiles on disk.
+    again = CutoutEngine(TileStore(tmp_path / "tiles"), size=50, fov_deg=5)
+    np.testing.assert_array_equal(again.cutout(SURVEY_URL, 10, -30), first)
+    assert len(server.requests) == downloads
+
+
+@pytest.mark.skipif(
+    not FIXTURE.exists(), reason="No recorded hips2fits cutouts (see the README)"
+)
+def test_cutouts_match_hips2fits(monkeypatch, no_waiting):
+    fixture = json.loads(FIXTURE.read_text(encoding="utf-8"))
+
+    def offline():
+        raise AssertionError("The recorded tiles should be all that's needed")
+
+    monkeypatch.setattr(throttle, "session", offline)
+    engine = CutoutEngine(
+        TileStore(FIXTURE.parent / fixture["tile_dir"], budget_mb=10**6),
+        fixture["size"],
+        fixture["fov_deg"],
+    )
+    for name, ra, dec in fixture["positions"]:
+        with Image.open(FIXTURE.parent / f"{name}.hips2fits.png") as reference:
+            reference = np.asarray(reference.convert("RGB"))
+        mean, p99 = compare(engine.cutout(fixture["survey_url"], ra, dec), reference)
+        assert mean <= MEAN_TOLERANCE, name
+        assert p99 <= P99_TOLERANCE, name
+
+
+def test_tiles_are_opt_in(monkeypatch, tmp_path):
+    get_images = pytest.importorskip("get_images")
+    calls = []
+    monkeypatch.setattr(get_images, "cut_out_image", lambda *args: calls.append(args))
+    monkeypatch.setattr(
+        get_images, "download_image", lambda *args: Path(args[4]).write_bytes(b"jpg")
+    )
+    monkeypatch.setattr(
+        get_images,
+        "get_best_survey",
+        lambda *args: {"ID": "CDS/P/DSS2/color", "hips_service_url": SURVEY_URL},
+    )
+    monkeypatch.setattr(
+        throttle, "call", lambda name, function, *args, **kwargs: Response(b"[]")
+    )
+    secrets_dict = {"HIPS_TILE_DIR": str(tmp_path / "tiles")}
+    get_images.fetch_hips_image(10, -30, tmp_path, secrets_dict=secrets_dict)
+    assert calls == []
+    secrets_dict["HIPS_LOCAL_CUTOUTS"] = True
+    get_images.fetch_hips_image(10, -30, tmp_path, secrets_dict=secrets_dict)
+    assert len(calls) == 1
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from sampler import StratifiedSampler, UnknownStratumError, parse_weights
+
+
+def test_parse_weights():
+    assert parse_weights("k2_hermes=3, galah_main=1", "survey_name") == {
+        "k2_hermes": 3.0,
+        "galah_main": 1.0,
+    }
+    assert parse_weights(None, None) == {}
+    assert parse_weights("named=2", "simbad_named") == {"named": 2.0}
+
+
+@pytest.mark.parametrize(
+    "weights_arg, stratify",
+    [
+        ("k2_hermes:3", "survey_name"),
+        ("a=b", "survey_name"),
+        ("=3", "survey_name"),
+        ("k2_hermes=-1", "survey_name"),
+        ("k2_hermes=3", None),
+        ("old=2", "bstep"),
+    ],
+)
+def test_bad_weights(weights_arg, stratify):
+    with pytest.raises(ValueError):
+        parse_weights(weights_arg, stratify)
+
+
+def test_weights_for_a_stratum_with_no_stars():
+    galah_dr3 = pd.DataFrame({"survey_name": ["galah_main", "k2_hermes  "]})
+    with pytest.raises(UnknownStratumError):
+        StratifiedSampler.from_catalogue(
+            galah_dr3, np.arange(2), "survey_name", {"tess_hermes": 2}
+        )
@@ -0,0 +1,215 @@
+import re
+import sqlite3
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import throttle
+from spectra_index import SpectraIndex, resolve
+
+# Wavelength range (metres) of each HERMES band.
+BANDS = {
+    "B": (4.71e-7, 4.90e-7),
+    "V": (5.64e-7, 5.88e-7),
+    "R": (6.47e-7, 6.74e-7),
+    "I": (7.59e-7, 7.89e-7),
+}
+
+FOUND_COLUMNS = ["sobject_id", "band_name", "access_url"]
+
+
+def has_spectra(sobject_id):
+    return sobject_id % 7 != 0
+
+
+def votable(rows, status="OK", message=""):
+    fields = "".join(
+        f'<FIELD name="{name}" datatype="{datatype}"{size}/>'
+        for name, datatype, size in [
+            ("target_name", "char", ' arraysize="*"'),
+            ("access_url", "char", ' arraysize="*"'),
+            ("em_min", "double", ""),
+            ("em_max", "double", ""),
+        ]
+    )
+    table = ""
+    if status != "ERROR":
+        data = "".join(
+            f"<TR><TD>{target}</TD><TD>{url}</TD><TD>{low}</TD><TD>{high}</TD></TR>"
+            for target, url, low, high in rows
+        )
+        table = f"<TABLE>{fields}<DATA><TABLEDATA>{data}</TABLEDATA></DATA></TABLE>"
+    return (
+        '<?xml version="1.0"?>'
+        '<VOTABLE version="1.3" xmlns="http://www.ivoa.net/xml/VOTable/v1.3">'
+        '<RESOURCE type="results"><INFO name="QUERY_STATUS" value="OK"/>'
+        f"{table}"
+        + (
+            f'<INFO name="QUERY_STATUS" value="{status}">{message}</INFO>'
+            if status != "OK"
+            else ""
+        )
+        + "</RESOURCE></VOTABLE>"
+    ).encode()
+
+
+class TapHandler(BaseHTTPRequestHandler):
+    """A TAP /sync endpoint with four spectra for most stars."""
+
+    def do_POST(self):
+        form = parse_qs(self.rfile.read(int(self.headers["Content-Length"])).decode())
+        query, maxrec = form["QUERY"][0], int(form["MAXREC"][0])
+        targets = [int(t) for t in re.findall(r"'(\d+)'", query.split(" IN ")[1])]
+        self.server.queries.append(targets)
+        rows = [
+            (target, f"https://spectra.test/{target}/{band}", low, high)
+            for target in targets
+            if has_spectra(target)
+            for band, (low, high) in BANDS.items()
+        ]
+        if self.server.mode == "overflow":
+            # As a service with a lower limit than MAXREC would answer.
+            body = votable(rows[: len(rows) // 2], "OVERFLOW")
+        elif self.server.mode == "maxrec":
+            # As many rows as were asked for, so there may have been more.
+            body = votable((rows * maxrec)[:maxrec])
+        elif self.server.mode == "error":
+            body = votable([], "ERROR", "Query timed out")
+        else:
+            body = votable(rows[:maxrec])
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-votable+xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def tap(tmp_path, monkeypatch):
+    monkeypatch.setattr(
+        throttle,
+        "_throttle",
+        throttle.Throttle(
+            tmp_path / "throttle", {"datacentral": {"rate": 1000, "burst": 1000}}
+        ),
+    )
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TapHandler)
+    server.queries = []
+    server.mode = "ok"
+    server.url = f"http://127.0.0.1:{server.server_port}/tap"
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def stars():
+    rng = np.random.default_rng(8)
+    return np.unique(170101000000000 + rng.integers(0, 10**9, 1200))
+
+
+def run(index, stars, tap):
+    return resolve(index, stars, batch_size=500, workers=2, tap_url=tap.url)
+
+
+def test_stars_are_looked_up_in_batches(tap, stars, tmp_path):
+    index = SpectraIndex(tmp_path / "spectra.sqlite")
+    assert run(index, stars, tap) == len(stars)
+    assert sorted(len(batch) for batch in tap.queries) == [200, 500, 500]
+    assert len(index) == len(stars)
+
+    found = next(s for s in stars if has_spectra(s))
+    spectra = index.lookup(found)
+    assert list(spectra["band_name"]) == ["B", "I", "R", "V"]
+    assert all(
+        url.endswith(f"/{band}")
+        for url, band in zip(spectra["access_url"], spectra["band_name"])
+    )
+    # Searched and has none, which isn't the same as never searched.
+    assert len(index.lookup(next(s for s in stars if not has_spectra(s)))) == 0
+    assert index.lookup(1) is None
+
+    # Nothing is asked for twice.
+    assert run(index, stars, tap) == 0
+    assert len(tap.queries) == 3
+
+
+@pytest.mark.parametrize("mode", ["overflow", "maxrec", "error"])
+def test_cut_short_results_are_not_saved(tap, stars, tmp_path, mode):
+    tap.mode = mode
+    index = SpectraIndex(tmp_path / "spectra.sqlite")
+    with pytest.raises(ValueError):
+        run(index, stars, tap)
+    assert len(index) == 0
+
+
+@contextmanager
+def spectrum(url, logger, metrics):
+    yield [type("HDU", (), {"header": {"WMIN": 1, "WMAX": 2}, "data": [1.0, 2.0]})]
+
+
+def test_read_only_index_does_not_write(stars, tmp_path):
+    index_file = tmp_path / "spectra.sqlite"
+    SpectraIndex(index_file).add(stars[:1], pd.DataFrame(columns=FOUND_COLUMNS))
+    before = index_file.read_bytes()
+    index = SpectraIndex(index_file, read_only=True)
+    assert len(index.lookup(stars[0])) == 0
+    with pytest.raises(sqlite3.OperationalError):
+        index.add(stars[1:2], pd.DataFrame(columns=FOUND_COLUMNS))
+    assert index_file.read_bytes() == before
+    with pytest.raises(sqlite3.OperationalError):
+        len(SpectraIndex(tmp_path / "missing.sqlite", read_only=True))
+    assert not (tmp_path / "missing.sqlite").exists()
+
+
+def test_fetch_spectra_trusts_the_index(stars, tmp_path, monkeypatch, caplog):
+    plot_spectra = pytest.importorskip("plot_spectra")
+    plot_spectra.open_index.cache_clear()
+    index_file = tmp_path / "spectra.sqlite"
+    index = SpectraIndex(index_file)
+    complete, partial, none, unknown = stars[:4]
+    found = pd.DataFrame(
+        {
+            "sobject_id": [complete] * 4 + [partial] * 2,
+            "band_name": ["B", "V", "R", "I", "B", "V"],
+            "access_url": [f"https://spectra.test/{i}" for i in range(6)],
+        }
+    )
+    index.add([complete, partial, none], found)
+
+    searched = []
+
+    def search_spectra(sobject_id, metrics=None):
+        searched.append(sobject_id)
+        return pd.DataFrame(
+            {"band_name": list(BANDS), "access_url": ["https://spectra.test/ssa"] * 4}
+        )
+
+    monkeypatch.setattr(plot_spectra, "search_spectra", search_spectra)
+    monkeypatch.setattr(plot_spectra, "fetch_spectrum", spectrum)
+    for sobject_id, bands in [
+        (complete, ["B", "I", "R", "V"]),
+        (partial, ["B", "V"]),
+        (none, []),
+        (unknown, ["B", "I", "R", "V"]),
+    ]:
+        spectra = plot_spectra.fetch_spectra(sobject_id, index_file=index_file)
+        assert sorted(spectra) == bands
+    assert searched == [unknown]
+
+    # Without the file every star is searched for, with one warning.
+    for sobject_id in [complete, partial]:
+        plot_spectra.fetch_spectra(sobject_id, index_file=tmp_path / "missing")
+    assert searched == [unknown, complete, partial]
+    assert not (tmp_path / "missing").exists()
+    assert caplog.text.count("No spectra index") == 1
@@ -0,0 +1,50 @@
+import json
+import os
+import time
+
+import pytest
+
+staging = pytest.importorskip("staging")
+
+
+def stage(queue, sobject_id):
+    tmp_dir = queue.reserve()
+    content = {
+        "sobject_id": sobject_id,
+        "hips_survey": "DSS2 color",
+        "BEST_NAME": f"Star {sobject_id}",
+        "tweet_text": "BIRD!",
+    }
+    for name in staging.alt_texts(content["hips_survey"], content["BEST_NAME"]):
+        (tmp_dir / name).write_bytes(b"png")
+    return queue.commit(tmp_dir, content)
+
+
+def test_a_bundle_staged_long_ago_is_not_removed_once_claimed(tmp_path):
+    queue = staging.StagingQueue(tmp_path)
+    bundle_dir = stage(queue, 1)
+    two_days_ago = time.time() - 2 * 86400
+    os.utime(bundle_dir, (two_days_ago, two_days_ago))
+
+    claimed, manifest = queue.pop()
+    assert manifest["sobject_id"] == 1
+    # Another process starting up while this one tweets it.
+    staging.StagingQueue(tmp_path)
+    assert claimed.exists()
+
+    queue.release(claimed)
+    assert len(queue) == 1
+    assert (
+        json.loads((queue.ready()[0] / staging.MANIFEST).read_text())["bundle_id"]
+        == bundle_dir.name
+    )
+
+
+def test_abandoned_claims_are_removed(tmp_path):
+    queue = staging.StagingQueue(tmp_path)
+    stage(queue, 1)
+    claimed, _ = queue.pop()
+    two_days_ago = time.time() - 2 * 86400
+    os.utime(claimed, (two_days_ago, two_days_ago))
+    staging.StagingQueue(tmp_path)
+    assert not claimed.exists()
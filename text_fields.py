@@ -0,0 +1,159 @@
+"""The text in the tweets, worked out for many stars at once.
+
+These give exactly the same strings as ``distance_str``, ``mass_str``,
+``age_str`` and the observation date in ``robot_galah.py``, but for whole
+columns, so they can be stored in the catalogue and looked up. Run this file
+with ``--verify`` to check that against the per-star versions."""
+
+import argparse
+import logging
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+TEXT_COLUMNS = ["text_obs_date", "text_distance", "text_mass", "text_age"]
+
+
+def _strings(mask, fmt, values):
+    """``fmt % value`` where ``mask`` is True, None elsewhere."""
+    out = np.full(len(mask), None, dtype=object)
+    if np.any(mask):
+        out[mask] = np.char.mod(fmt, values[mask]).astype(object)
+    return out
+
+
+def obs_date_strs(sobject_id):
+    """The night each star was observed, from the first six digits of sobject_id."""
+    yymmdd = np.asarray(sobject_id).astype(str).astype("<U6")
+    # There are only a few thousand nights, so format each one once.
+    nights, inverse = np.unique(yymmdd, return_inverse=True)
+    formatted = np.array(
+        [
+            datetime.strptime(night, "%y%m%d").date().strftime("%-d %b %Y")
+            for night in nights
+        ],
+        dtype=object,
+    )
+    return formatted[inverse.reshape(-1)]
+
+
+def distance_strs(distance_bstep, e_distance_bstep):
+    """Distances in pc or kpc, rounded to the size of their errors."""
+    distance = np.asarray(distance_bstep, dtype=float) * 1000
+    e_distance = np.asarray(e_distance_bstep, dtype=float) * 1000
+    good = np.isfinite(distance) & np.isfinite(e_distance)
+    # The number of digits in the integer part of the error.
+    int_error = np.trunc(np.abs(np.where(good, e_distance, 0))).astype(np.int64)
+    powers = 10 ** np.arange(19, dtype=np.int64)
+    n_digits = np.maximum(np.searchsorted(powers, int_error, side="right"), 1)
+    error_size = powers[n_digits - 1]
+    rounded = np.trunc(
+        np.round(np.where(good, distance, 0) / error_size) * error_size
+    ).astype(np.int64)
+    pc = _strings(good & (rounded < 1000), "%d pc", rounded)
+    kpc = _strings(good & (rounded > 1000), "%0.1f kpc", rounded / 1000)
+    return np.where(pc == None, kpc, pc)  # noqa: E711
+
+
+def mass_strs(m_act_bstep):
+    mass = np.asarray(m_act_bstep, dtype=float)
+    return _strings(~np.isnan(mass), "%0.1f solar masses", mass)
+
+
+def age_strs(age_bstep):
+    age = np.asarray(age_bstep, dtype=float)
+    gyr = _strings(age >= 1, "%0.1f Gyr", age)
+    myr = _strings(age < 1, "%0.0f Myr", age * 1000)
+    return np.where(gyr == None, myr, gyr)  # noqa: E711
+
+
+def add_text_columns(galah_dr3, rows=None):
+    """Adds the TEXT_COLUMNS to the catalogue for ``rows`` (positions).
+
+    Other rows, and stars without BSTEP values, get None."""
+    logger = logging.getLogger("text_fields")
+    if rows is None:
+        rows = np.arange(len(galah_dr3))
+    logger.info("Working out the tweet text for %i stars", len(rows))
+    has_bstep = ~np.isnan(galah_dr3["age_bstep"].to_numpy()[rows])
+    values = {
+        "text_obs_date": obs_date_strs(galah_dr3["sobject_id"].to_numpy()[rows]),
+        "text_distance": distance_strs(
+            galah_dr3["distance_bstep"].to_numpy()[rows],
+            galah_dr3["e_distance_bstep"].to_numpy()[rows],
+        ),
+        "text_mass": mass_strs(galah_dr3["m_act_bstep"].to_numpy()[rows]),
+        "text_age": age_strs(galah_dr3["age_bstep"].to_numpy()[rows]),
+    }
+    for column, column_values in values.items():
+        if column != "text_obs_date":
+            column_values = np.where(has_bstep, column_values, None)
+        full = np.full(len(galah_dr3), None, dtype=object)
+        full[rows] = column_values
+        galah_dr3[column] = pd.Series(full, index=galah_dr3.index, dtype=object)
+    return galah_dr3
+
+
+def verify_text_columns(galah_dr3, rows):
+    """Compares the text columns with the per-star functions. Returns mismatches."""
+    # Imported here as robot_galah needs everything used to make a tweet.
+    from robot_galah import age_str, distance_str, mass_str
+
+    mismatches = []
+    for position in rows:
+        the_star = galah_dr3.iloc[position]
+        expected = {
+            "text_obs_date": datetime.strptime(
+                str(the_star["sobject_id"])[:6], "%y%m%d"
+            )
+            .date()
+            .strftime("%-d %b %Y")
+        }
+        if not np.isnan(the_star["age_bstep"]):
+            try:
+                expected["text_distance"] = distance_str(the_star)
+            except ValueError:
+                # A NaN distance error, which the per-star version can't do.
+                expected["text_distance"] = None
+            expected["text_mass"] = mass_str(the_star)
+            expected["text_age"] = age_str(the_star)
+        for column, value in expected.items():
+            if the_star[column] != value:
+                mismatches.append(
+                    (the_star["sobject_id"], column, the_star[column], value)
+                )
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("catalogue_file", help="The catalogue HDF5 file.")
+    parser.add_argument(
+        "--verify",
+        help="Check every eligible star against the per-star functions.",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--write", help="Save the catalogue with the text columns to this file."
+    )
+    args = parser.parse_args()
+
+    # catalogue.py imports this module, so import it here.
+    from catalogue import basic_cuts
+
+    galah_dr3 = pd.read_hdf(args.catalogue_file)
+    rows = np.flatnonzero(basic_cuts(galah_dr3).to_numpy())
+    add_text_columns(galah_dr3, rows)
+    if args.verify:
+        mismatches = verify_text_columns(galah_dr3, rows)
+        for mismatch in mismatches[:20]:
+            print("Mismatch for %s in %s: %r != %r" % mismatch)
+        print(f"{len(mismatches)} mismatches in {len(rows)} stars")
+    if args.write:
+        galah_dr3.to_hdf(args.write, key="galah_dr3")
+        print(f"Saved to {args.write}")
+
+
+if __name__ == "__main__":
+    main()
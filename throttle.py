@@ -0,0 +1,258 @@
+"""Keeps the requests to each upstream service under the rate it tolerates.
+
+Each service has a token bucket (``rate`` requests a second, up to ``burst``
+at once) and at most ``max_in_flight`` requests running, shared by every
+thread and process using the same state directory. The bucket is a small
+file updated under an exclusive lock, and each in-flight slot is a lock file
+held while the request runs, so a process that dies gives its slot back.
+When a service answers 429 or 503 its rate is halved for every caller (and
+nobody asks it anything until any Retry-After has passed), then it creeps
+back up with each request that works."""
+
+import fcntl
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import requests
+
+# Requests a second, the most at once, and the most running at the same time.
+DEFAULT_LIMITS = {
+    "simbad": {"rate": 5.0, "burst": 5, "max_in_flight": 2},
+    "mocserver": {"rate": 5.0, "burst": 5, "max_in_flight": 4},
+    "hips2fits": {"rate": 2.0, "burst": 2, "max_in_flight": 2},
+    "hips_tiles": {"rate": 20.0, "burst": 20, "max_in_flight": 8},
+    "datacentral": {"rate": 5.0, "burst": 5, "max_in_flight": 4},
+    "twitter_media": {"rate": 1.0, "burst": 4, "max_in_flight": 1},
+}
+THROTTLED = (429, 503)
+# tokens, last refill (unix time), rate scale, no requests before (unix time)
+STATE = struct.Struct("<dddd")
+# The rate is never cut below this fraction of the configured one.
+MIN_SCALE = 1 / 32
+# Added to the rate scale after each request that wasn't throttled.
+RECOVERY = 0.05
+# How long to stop for after a throttled request without a Retry-After.
+BACKOFF_S = 2.0
+MAX_BACKOFF_S = 120.0
+# How often to look for a free in-flight slot.
+SLOT_POLL_S = 0.02
+
+
+_local = threading.local()
+
+
+def session():
+    """A requests Session for this thread, kept so connections are reused.
+
+    Sessions aren't safe to share between threads, so each thread (the
+    daemon's, the stager's and the tile download threads) gets its own."""
+    if not hasattr(_local, "session"):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def default_state_dir():
+    shm = Path("/dev/shm")
+    root = shm if shm.is_dir() else Path(tempfile.gettempdir())
+    return Path.joinpath(root, "robot_galah_throttle")
+
+
+def status_of(outcome):
+    """The HTTP status of a response, or of the error a failed request raised."""
+    status = getattr(outcome, "status_code", None)
+    if status is None:
+        # requests (and astroquery) errors have the response, pyvo's the code.
+        response = getattr(outcome, "response", None)
+        status = getattr(response, "status_code", None) or getattr(
+            outcome, "code", None
+        )
+    try:
+        return int(status)
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after(outcome):
+    response = (
+        outcome if hasattr(outcome, "headers") else getattr(outcome, "response", None)
+    )
+    try:
+        return float(response.headers["Retry-After"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class Service:
+    """The shared bucket and in-flight slots for one service."""
+
+    def __init__(self, name, state_dir, rate, burst, max_in_flight):
+        self.name = name
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.max_in_flight = int(max_in_flight)
+        self.state_path = Path.joinpath(state_dir, f"{name}.bucket")
+        self.slot_paths = [
+            Path.joinpath(state_dir, f"{name}.slot{i}")
+            for i in range(self.max_in_flight)
+        ]
+        self.logger = logging.getLogger("throttle")
+
+    @contextmanager
+    def _state(self):
+        """The bucket's state, as a list to change, written back afterwards."""
+        fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            data = os.pread(fd, STATE.size, 0)
+            if len(data) == STATE.size:
+                state = list(STATE.unpack(data))
+            else:
+                state = [self.burst, time.time(), 1.0, 0.0]
+            yield state
+            os.pwrite(fd, STATE.pack(*state), 0)
+        finally:
+            os.close(fd)
+
+    def _take_token(self):
+        """Takes a token if there is one. Otherwise how long to wait for one."""
+        with self._state() as state:
+            tokens, updated, scale, not_before = state
+            now = time.time()
+            if now < not_before:
+                return not_before - now
+            rate = self.rate * scale
+            tokens = min(self.burst, tokens + max(now - updated, 0) * rate)
+            state[1] = now
+            if tokens >= 1:
+                state[0] = tokens - 1
+                return 0
+            state[0] = tokens
+            return (1 - tokens) / rate
+
+    def _take_slot(self):
+        """An open, locked slot file, or None if they're all in use."""
+        for path in self.slot_paths:
+            slot = open(path, "a")
+            try:
+                fcntl.flock(slot, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return slot
+            except BlockingIOError:
+                slot.close()
+        return None
+
+    @contextmanager
+    def acquire(self):
+        """Waits for a token and a slot. Yields how long that took."""
+        started = time.perf_counter()
+        slot = None
+        try:
+            while slot is None:
+                wait = self._take_token()
+                if wait > 0:
+                    time.sleep(wait)
+                    continue
+                slot = self._take_slot()
+                while slot is None:
+                    time.sleep(SLOT_POLL_S)
+                    slot = self._take_slot()
+            yield time.perf_counter() - started
+        finally:
+            if slot is not None:
+                slot.close()
+
+    def report(self, status, wait_s=None):
+        """Slows down after a 429 or 503, and speeds back up otherwise."""
+        with self._state() as state:
+            if status in THROTTLED:
+                state[2] = max(state[2] / 2, MIN_SCALE)
+                if wait_s is None:
+                    wait_s = BACKOFF_S / state[2]
+                wait_s = min(wait_s, MAX_BACKOFF_S)
+                state[3] = max(state[3], time.time() + wait_s)
+                self.logger.warning(
+                    "%s answered %i, waiting %.1f s and cutting the rate to %.2f/s",
+                    self.name,
+                    status,
+                    wait_s,
+                    self.rate * state[2],
+                )
+            elif state[2] < 1:
+                state[2] = min(state[2] + RECOVERY, 1.0)
+
+
+class Throttle:
+    """The services, with ``limits`` overriding DEFAULT_LIMITS for some of them."""
+
+    def __init__(self, state_dir=None, limits=None):
+        self.state_dir = Path(state_dir) if state_dir else default_state_dir()
+        self.state_dir.mkdir(parents=True, exist_ok=True)
+        self.limits = {name: dict(limit) for name, limit in DEFAULT_LIMITS.items()}
+        for name, limit in (limits or {}).items():
+            self.limits.setdefault(name, dict(DEFAULT_LIMITS["simbad"])).update(limit)
+        self.services = {
+            name: Service(name, self.state_dir, **limit)
+            for name, limit in self.limits.items()
+        }
+        self.logger = logging.getLogger("throttle")
+
+    def call(self, name, function, *args, metrics=None, retries=3, **kwargs):
+        """``function(*args, **kwargs)`` once ``name`` can take another request.
+
+        Throttled requests are tried again up to ``retries`` times; after that
+        the last response is returned (or its error raised). Time spent
+        waiting goes in the ``throttle.<name>`` stage of ``metrics``."""
+        service = self.services[name]
+        for attempt in range(retries + 1):
+            with service.acquire() as waited:
+                if metrics is not None:
+                    metrics.merge({"stages": {f"throttle.{name}": waited}})
+                try:
+                    outcome = function(*args, **kwargs)
+                except Exception as e:
+                    status = status_of(e)
+                    if status not in THROTTLED or attempt == retries:
+                        if status is not None:
+                            service.report(status)
+                        raise
+                    service.report(status, retry_after(e))
+                    continue
+            status = status_of(outcome)
+            service.report(status, retry_after(outcome))
+            if status not in THROTTLED or attempt == retries:
+                return outcome
+        return outcome
+
+
+_throttle = None
+_throttle_lock = threading.Lock()
+
+
+def configure(secrets_dict):
+    """Uses ``THROTTLE_DIR`` and ``RATE_LIMITS`` from the secrets, if they're set.
+
+    ``RATE_LIMITS`` is e.g. ``{"simbad": {"rate": 2, "max_in_flight": 1}}``."""
+    global _throttle
+    with _throttle_lock:
+        _throttle = Throttle(
+            secrets_dict.get("THROTTLE_DIR"), secrets_dict.get("RATE_LIMITS")
+        )
+    return _throttle
+
+
+def get_throttle():
+    global _throttle
+    with _throttle_lock:
+        if _throttle is None:
+            _throttle = Throttle()
+        return _throttle
+
+
+def call(name, function, *args, **kwargs):
+    """``Throttle.call`` on this process's throttle."""
+    return get_throttle().call(name, function, *args, **kwargs)
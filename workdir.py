@@ -0,0 +1,50 @@
+"""Per-run work directories for the images we make and tweet."""
+
+import logging
+import os
+import shutil
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+CLEANUP_POLICIES = ["always", "on_success", "never"]
+
+
+@contextmanager
+def work_dir(base_dir, run_id, cleanup="on_success"):
+    """Makes ``base_dir/run_id`` for one run and removes it afterwards.
+
+    With ``cleanup="on_success"`` the directory is left behind if the run
+    fails (including sys.exit with a message) so the images can be looked at."""
+    logger = logging.getLogger("workdir")
+    if cleanup not in CLEANUP_POLICIES:
+        raise ValueError(f"cleanup must be one of {CLEANUP_POLICIES}")
+    path = Path.joinpath(Path(base_dir), f"{run_id}_{os.getpid()}")
+    path.mkdir(parents=True)
+    logger.debug("Created work directory %s", path)
+    succeeded = False
+    try:
+        yield path
+        succeeded = True
+    finally:
+        if cleanup == "always" or (cleanup == "on_success" and succeeded):
+            logger.debug("Deleting work directory %s", path)
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            logger.info("Keeping work directory %s", path)
+
+
+def sweep(base_dir, max_age_days=7):
+    """Deletes work directories left behind by runs more than a few days old."""
+    logger = logging.getLogger("workdir")
+    base_dir = Path(base_dir)
+    if not base_dir.exists():
+        return
+    for path in base_dir.iterdir():
+        if time.time() - path.stat().st_mtime < max_age_days * 86400:
+            continue
+        logger.debug("Deleting old %s", path)
+        if path.is_dir():
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            path.unlink()